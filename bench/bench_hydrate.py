@@ -0,0 +1,122 @@
+"""
+Rows/sec of Doc.new for flat, nested and ListOfDocsField documents.
+
+No database is needed.  The field-by-field isinstance walk Doc.new used
+before per-class hydration steps is kept here as "legacy" so both can be
+timed side by side:
+
+    python bench/bench_hydrate.py --rows 20000
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ocm import Doc, Field, AutoIncField, ListOfDocsField, OCMInvalidException
+
+
+class Item(Doc):
+    fields = [Field(str, "sku"),
+              Field(int, "qty"),
+              Field(float, "price")]
+
+class Address(Doc):
+    fields = [Field(str, "street"),
+              Field(str, "city"),
+              Field(str, "zip")]
+
+class Flat(Doc):
+    fields = [AutoIncField("num", "flat_seq"),
+              Field(str, "name", required=True),
+              Field(int, "count"),
+              Field(float, "total"),
+              Field(str, "status", default="new"),
+              Field(list, "tags")]
+
+class Nested(Doc):
+    fields = [Field(str, "name"),
+              Field(Address, "ship_to"),
+              Field(Address, "bill_to")]
+
+class Order(Doc):
+    fields = [Field(str, "name"),
+              ListOfDocsField(Item, "items")]
+
+
+def legacy_new(cls, data=None):
+    # Plain dict writes, as Doc had no change tracking back then
+    o = cls()
+    if 0 == len(o.fields):
+        raise OCMInvalidException
+    if data and isinstance(data, dict):
+        dict.update(o, data)
+
+    for f in o.fields:
+        if isinstance(f, AutoIncField):
+            if not o.has_key(f.name):
+                dict.__setitem__(o, f.name, None)
+                continue
+
+        if f.default and not o.has_key(f.name):
+            dict.__setitem__(o, f.name, f.default)
+
+        if o.has_key(f.name):
+            if isinstance(o[f.name], f.fldtype):
+                pass
+            elif f.fldtype == int:
+                dict.__setitem__(o, f.name, int(float(o[f.name])))
+            elif isinstance(f, ListOfDocsField):
+                l = []
+                for item in o[f.name]:
+                    l.append(legacy_new(f.fldtype, item))
+                dict.__setitem__(o, f.name, l)
+            elif Doc in f.fldtype.__bases__:
+                dict.__setitem__(o, f.name, legacy_new(f.fldtype, o[f.name]))
+            else:
+                dict.__setitem__(o, f.name, f.fldtype(o[f.name]))
+
+    o.is_valid()
+    return o
+
+
+def rows(kind, n):
+    if kind == "flat":
+        return Flat, [{"name": "row %d" % i, "count": "%d" % i, "total": i * 1.5,
+                       "tags": ["a", "b"]} for i in range(n)]
+    if kind == "nested":
+        addr = {"street": "1 Main", "city": "Springfield", "zip": "12345"}
+        return Nested, [{"name": "row %d" % i, "ship_to": dict(addr),
+                         "bill_to": dict(addr)} for i in range(n)]
+    items = [{"sku": "sku-%d" % i, "qty": i, "price": 9.99} for i in range(20)]
+    return Order, [{"name": "row %d" % i, "items": [dict(x) for x in items]}
+                   for i in range(n)]
+
+
+def timeit(fn, cls, data):
+    start = time.time()
+    for d in data:
+        fn(cls, d)
+    return len(data) / (time.time() - start)
+
+
+def main():
+    p = OptionParser()
+    p.add_option("--rows", type="int", default=20000)
+    opts, args = p.parse_args()
+
+    print "%-8s %14s %14s %8s" % ("shape", "legacy rows/s", "new rows/s", "speedup")
+    for kind in ("flat", "nested", "listofdocs"):
+        n = opts.rows
+        if kind == "listofdocs":
+            n = max(1, n / 20)
+        cls, data = rows(kind, n)
+        old = timeit(legacy_new, cls, data)
+        cls, data = rows(kind, n)
+        new = timeit(lambda c, d: c.new(d), cls, data)
+        print "%-8s %14.0f %14.0f %7.2fx" % (kind, old, new, new / old)
+
+
+if __name__ == "__main__":
+    main()
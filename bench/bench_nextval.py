@@ -0,0 +1,90 @@
+"""
+Sequence contention benchmark for Mgr._nextval.
+
+Runs 1, 8 and 64 writer threads against one sequence on a live mongod and
+reports values/sec, plus how many duplicate values were handed out.  The
+old read-then-compare-and-swap loop is kept here as "cas" so the two can
+be compared on the same box:
+
+    python bench/bench_nextval.py --host localhost --port 27017 --db test
+"""
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ocm import Mgr
+
+
+def cas_nextval(mgr, seqname, retries=100):
+    # The pre-findAndModify algorithm, for comparison only.
+    with mgr._db() as mdb:
+        coll = mdb.sequences
+        obj = coll.find_one( {"seqname": seqname, "lastval" : { "$gte" : 0}} )
+        if not obj:
+            coll.save({"seqname": seqname, "lastval": 1})
+            return 1
+
+        v = obj["lastval"]
+        vnew = v
+        r = 0
+        while r < retries:
+            vnew += 1
+            coll.update( { "seqname": seqname, "lastval": v }, { "$set": {"lastval": vnew} } )
+            rslt = mdb.command({"getlasterror":1})
+            if rslt["updatedExisting"]:
+                break
+            r += 1
+    return vnew
+
+
+def run(mgr, nextval, writers, per_writer, seqname):
+    with mgr._db() as mdb:
+        mdb.sequences.remove({"seqname": seqname})
+
+    got = []
+    lock = threading.Lock()
+    def work():
+        mine = [nextval(mgr, seqname) for x in range(per_writer)]
+        lock.acquire()
+        got.extend(mine)
+        lock.release()
+
+    threads = [threading.Thread(target=work) for x in range(writers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    return len(got) / elapsed, len(got) - len(set(got))
+
+
+def main():
+    p = OptionParser()
+    p.add_option("--host", default="localhost")
+    p.add_option("--port", type="int", default=27017)
+    p.add_option("--db", default="test")
+    p.add_option("--values", type="int", default=6400,
+                 help="total values drawn per run")
+    p.add_option("--writers", default="1,8,64")
+    opts, args = p.parse_args()
+
+    algos = [("findAndModify", lambda m, s: m._nextval(s)),
+             ("cas", cas_nextval)]
+
+    print "%-14s %8s %12s %6s" % ("algorithm", "writers", "values/sec", "dups")
+    for name, fn in algos:
+        for w in [int(x) for x in opts.writers.split(",")]:
+            mgr = Mgr(opts.host, opts.port, opts.db, max_pool_size=w)
+            rate, dups = run(mgr, fn, w, max(1, opts.values / w), "bench_nextval")
+            print "%-14s %8d %12.0f %6d" % (name, w, rate, dups)
+            mgr.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Rows/sec of Mgr._hydrate and Doc.validate_many in 1, 2, 4 and 8 worker
+processes, to see how parallel hydration scales across the cores of a
+box.
+
+The docs have to be pickled back from the workers, which costs about as
+much as hydrating a plain doc, so "light" docs only gain with plenty of
+cores.  "heavy" docs have an app validate() that does real work, which is
+where the workers pay off.
+
+No database is needed - the rows are made up and handed straight to
+_hydrate, the same way iter_get hands it a cursor:
+
+    python bench/bench_parallel.py --rows 100000 --workers 1,2,4,8
+"""
+import hashlib
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bson.objectid
+from ocm import Mgr, Doc, Field, ListOfDocsField
+
+
+def status_ok(f, v):
+    if v not in ("new", "paid"):
+        return "bad status"
+
+class Item(Doc):
+    fields = [Field(str, "sku", required=True),
+              Field(int, "qty"),
+              Field(float, "price")]
+
+class Order(Doc):
+    mgr = Mgr("localhost", 27017, "test")
+    collection = "bench_parallel"
+    fields = [Field(str, "name", required=True),
+              Field(int, "count"),
+              Field(float, "total"),
+              Field(str, "status", default="new", validator=status_ok),
+              ListOfDocsField(Item, "items", lazy=False)]
+
+class HeavyOrder(Order):
+    fields = Order.fields
+    
+    def validate(self, item):
+        h = item["name"]
+        for x in range(200):
+            h = hashlib.sha1(h).hexdigest()
+        if h.startswith("0000"):
+            return ("name", "unlucky")
+
+
+def rows(n):
+    items = [{"sku": "sku-%d" % i, "qty": "%d" % i, "price": 9.99} for i in range(5)]
+    return [{"_id": bson.objectid.ObjectId(), "name": "row %d" % i, "count": "%d" % i,
+             "total": i * 1.5, "items": [dict(x) for x in items]} for i in range(n)]
+
+
+def main():
+    p = OptionParser()
+    p.add_option("--rows", type="int", default=100000)
+    p.add_option("--workers", default="1,2,4,8")
+    opts, args = p.parse_args()
+
+    print "%-6s %8s %16s %16s %8s" % ("shape", "workers", "hydrate rows/s", 
+                                      "validate docs/s", "speedup")
+    for shape, cls in (("light", Order), ("heavy", HeavyOrder)):
+        n = opts.rows
+        if shape == "heavy":
+            n = max(1, n / 10)
+        base = None
+        for w in [int(x) for x in opts.workers.split(",")]:
+            data = rows(n)
+            start = time.time()
+            docs = list(cls.mgr._hydrate(cls, data, workers=w))
+            hydrate = len(docs) / (time.time() - start)
+
+            start = time.time()
+            cls.validate_many(docs, workers=w)
+            validate = len(docs) / (time.time() - start)
+
+            if base is None:
+                base = hydrate
+            print "%-6s %8d %16.0f %16.0f %7.2fx" % (shape, w, hydrate, validate, hydrate / base)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+The ocm benchmark suite: ops/sec for each hot path, written out as JSON
+and compared against a stored baseline to catch regressions.
+
+    python bench/suite.py                        # against a local mongod
+    python bench/suite.py --backend mongomock    # in process, needs mongomock 2.x
+    python bench/suite.py --backend none         # only what needs no server
+
+    python bench/suite.py --out results.json
+    python bench/suite.py --save-baseline bench/baseline.json
+    python bench/suite.py --baseline bench/baseline.json --tolerance 0.15
+
+With --baseline, a benchmark more than tolerance slower than its
+baseline is flagged REGRESSED and the exit status is 1, so the suite can
+gate a build.  A baseline only means something on the box and backend it
+was made on - make one there first with --save-baseline.
+
+The mongomock backend needs a mongomock that still speaks the pymongo 2.x
+API ocm uses (safe=, fields=, find_and_modify): pip install "mongomock<3".
+mongomock scans the whole collection for every query, so use --scale 0.1
+or so with it.
+
+bench_hydrate.py, bench_nextval.py and bench_parallel.py go deeper into
+single areas; this is the broad, repeatable run.
+"""
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ocm import Mgr, Doc, Field
+from bench_hydrate import Flat, rows
+from bench_nextval import run as run_nextval
+
+
+class Record(Doc):
+    mgr = None          # set from the command line
+    collection = "bench_suite"
+    fields = [Field(str, "name", required=True),
+              Field(int, "hits"),
+              Field(float, "total"),
+              Field(str, "status", default="new"),
+              Field(list, "tags")]
+
+
+def record(i):
+    return {"name": "row %d" % i, "hits": i, "total": i * 1.5, "tags": ["a", "b"]}
+
+
+# Each benchmark is setup(mgr, n) -> (ops, fn): fn does ops operations and
+# is what gets timed.
+
+def hydrate(kind):
+    def setup(mgr, n):
+        if kind == "listofdocs":
+            n = max(1, n / 20)
+        cls, data = rows(kind, n)
+        def fn():
+            for d in data:
+                cls.new(d)
+        return n, fn
+    return setup
+
+def validate(mgr, n):
+    cls, data = rows("flat", n)
+    docs = [cls.new(d) for d in data]
+    def fn():
+        for d in docs:
+            d._validate()
+    return n, fn
+
+def getattr_(mgr, n):
+    o = Flat.new(rows("flat", 1)[1][0])
+    def fn():
+        for i in xrange(n):
+            o.total
+    return n, fn
+
+def setattr_(mgr, n):
+    o = Flat.new(rows("flat", 1)[1][0])
+    def fn():
+        for i in xrange(n):
+            o.total = i
+    return n, fn
+
+def makenicespec(mgr, n):
+    spec = {"name": "row 1", "count": "5", "total": {"$gt": "1.5"}, "status": {"$in": ["new"]}}
+    def fn():
+        for i in xrange(n):
+            Flat._makeNiceSpec(Flat, spec)
+    return n, fn
+
+def save_insert(mgr, n):
+    # Start each run from an empty collection, so every repeat times
+    # the same inserts
+    reset(mgr)
+    docs = [Record.new(record(i)) for i in range(n)]
+    def fn():
+        for d in docs:
+            d.save()
+    return n, fn
+
+def seed(mgr, n):
+    # n fresh rows, so a benchmark doesn't depend on what ran before it
+    reset(mgr)
+    Record.save_all([Record.new(record(i)) for i in range(n)])
+
+def save_update(mgr, n):
+    seed(mgr, n)
+    docs = Record.find(limit=n)
+    def fn():
+        for d in docs:
+            d.hits += 1
+            d.save()
+    return len(docs), fn
+
+def get(mgr, n):
+    seed(mgr, n)
+    n = max(1, n / 10)
+    def fn():
+        for i in xrange(n):
+            Record.find({"status": "new"}, limit=100)
+    return n, fn
+
+def retrieve(mgr, n):
+    seed(mgr, n)
+    ids = [d["_id"] for d in Record.find(projection=["_id"], limit=n)]
+    def fn():
+        for _id in ids:
+            Record.retrieve({"_id": _id})
+    return len(ids), fn
+
+def count(mgr, n):
+    seed(mgr, n)
+    def fn():
+        for i in xrange(n):
+            Record.count({"status": "new"})
+    return n, fn
+
+def nextval(writers):
+    def setup(mgr, n):
+        def fn():
+            rate, dups = run_nextval(mgr, lambda m, s: m._nextval(s), writers,
+                                     max(1, n / writers), "bench_suite")
+            if dups:
+                raise AssertionError("_nextval handed out %d duplicates" % dups)
+        return max(1, n / writers) * writers, fn
+    return setup
+
+
+# name, needs a server, setup, default ops
+BENCHMARKS = [
+    ("hydrate_flat",       False, hydrate("flat"),       20000),
+    ("hydrate_nested",     False, hydrate("nested"),     20000),
+    ("hydrate_listofdocs", False, hydrate("listofdocs"), 20000),
+    ("validate",           False, validate,              20000),
+    ("getattr",            False, getattr_,              200000),
+    ("setattr",            False, setattr_,              200000),
+    ("makenicespec",       False, makenicespec,          50000),
+    ("save_insert",        True,  save_insert,           2000),
+    ("save_update",        True,  save_update,           2000),
+    ("get",                True,  get,                   2000),
+    ("retrieve",           True,  retrieve,              2000),
+    ("count",              True,  count,                 2000),
+    ("nextval_1",          True,  nextval(1),            2000),
+    ("nextval_8",          True,  nextval(8),            2000),
+]
+
+
+class Locked(object):
+    """
+    A mongomock client, database or collection whose calls hold one lock.
+    A server applies each operation atomically and mongomock doesn't, so
+    without this nextval_8 measures mongomock's races rather than ocm.
+    """
+    def __init__(self, target, lock):
+        self._target = target
+        self._lock = lock
+    
+    def __getitem__(self, name):
+        return Locked(self._target[name], self._lock)
+    
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if isinstance(attr, (mongomock.Database, mongomock.Collection)):
+            return Locked(attr, self._lock)
+        if not callable(attr):
+            return attr
+        def call(*l, **kw):
+            with self._lock:
+                return attr(*l, **kw)
+        return call
+    
+    def disconnect(self):
+        pass
+
+
+def make_mgr(opts, parser):
+    if opts.backend == "none":
+        return None
+    connect = None
+    if opts.backend == "mongomock":
+        if mongomock is None:
+            parser.error('--backend mongomock needs mongomock: pip install "mongomock<3"')
+        if not mongomock.__version__.startswith("2."):
+            parser.error('--backend mongomock needs mongomock 2.x for the pymongo 2 API, '
+                         'found %s: pip install "mongomock<3"' % mongomock.__version__)
+        client = Locked(mongomock.MongoClient(), threading.Lock())
+        connect = lambda host, port: client
+    return Mgr(opts.host, opts.port, opts.db, max_pool_size=8, connect=connect)
+
+def reset(mgr):
+    with mgr._db() as mdb:
+        mdb.bench_suite.remove()
+        mdb.sequences.remove({"seqname": "bench_suite"})
+
+def run(opts, mgr):
+    only = opts.only and opts.only.split(",")
+    results = {}
+    for name, needs_db, setup, n in BENCHMARKS:
+        if only and name not in only:
+            continue
+        if needs_db and mgr is None:
+            continue
+
+        best = None
+        for r in range(opts.repeat):
+            ops, fn = setup(mgr, max(1, int(n * opts.scale)))
+            if not ops:
+                break
+            start = time.time()
+            fn()
+            elapsed = time.time() - start
+            if best is None or elapsed / ops < best[1] / best[0]:
+                best = (ops, elapsed)
+
+        if best is None:
+            print "%-20s %14s" % (name, "nothing to time")
+            continue
+        ops, elapsed = best
+        results[name] = {"ops": ops, "seconds": elapsed,
+                         "ops_per_sec": ops / max(elapsed, 1e-9)}
+        print "%-20s %14.0f ops/sec" % (name, results[name]["ops_per_sec"])
+        sys.stdout.flush()
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Print each benchmark against the baseline.  Returns the names that
+    got slower by more than tolerance.
+    """
+    print
+    print "%-20s %14s %14s %8s  %s" % ("benchmark", "baseline", "now", "change", "")
+    regressed = []
+    for name in sorted(results):
+        now = results[name]["ops_per_sec"]
+        if name not in baseline:
+            print "%-20s %14s %14.0f %8s  new" % (name, "-", now, "")
+            continue
+        was = baseline[name]["ops_per_sec"]
+        change = (now - was) / was
+        status = "ok"
+        if change < -tolerance:
+            status = "REGRESSED"
+            regressed.append(name)
+        elif change > tolerance:
+            status = "faster"
+        print "%-20s %14.0f %14.0f %+7.1f%%  %s" % (name, was, now, change * 100, status)
+    return regressed
+
+
+def main():
+    p = OptionParser()
+    p.add_option("--backend", default="mongod", choices=["mongod", "mongomock", "none"])
+    p.add_option("--host", default="localhost")
+    p.add_option("--port", type="int", default=27017)
+    p.add_option("--db", default="test")
+    p.add_option("--only", help="comma separated benchmark names")
+    p.add_option("--scale", type="float", default=1.0,
+                 help="multiply every benchmark's op count, e.g. 0.1 for a quick run")
+    p.add_option("--repeat", type="int", default=3, help="runs per benchmark, best is kept")
+    p.add_option("--out", help="write the results here as JSON")
+    p.add_option("--baseline", help="JSON results to compare against")
+    p.add_option("--save-baseline", dest="save_baseline",
+                 help="write the results here as the new baseline")
+    p.add_option("--tolerance", type="float", default=0.15,
+                 help="slowdown against the baseline that counts as a regression")
+    opts, args = p.parse_args()
+
+    mgr = make_mgr(opts, p)
+    if mgr:
+        Record.mgr = mgr
+        reset(mgr)
+
+    doc = {"meta": {"backend": opts.backend,
+                    "python": platform.python_version(),
+                    "machine": platform.node(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "scale": opts.scale,
+                    "repeat": opts.repeat},
+           "results": run(opts, mgr)}
+
+    if mgr:
+        reset(mgr)
+        if opts.backend == "mongod":
+            mgr.close()
+
+    for path in (opts.out, opts.save_baseline):
+        if path:
+            f = open(path, "w")
+            try:
+                json.dump(doc, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+
+    if opts.baseline:
+        f = open(opts.baseline)
+        try:
+            baseline = json.load(f)["results"]
+        finally:
+            f.close()
+        if compare(doc["results"], baseline, opts.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
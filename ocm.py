@@ -1,11 +1,710 @@
 from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from bson import BSON
+from bson.objectid import ObjectId
 from pymongo import Connection
+from pymongo.errors import OperationFailure, DuplicateKeyError
 import pymongo
+import base64
+import copy
+import logging
+import multiprocessing
+import pickle
+import threading
+import time
+import types
+import weakref
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 needs the "futures" backport for AsyncMgr
+    ThreadPoolExecutor = None
 
 
 
 class OCMInvalidException(Exception): pass
 class OCMNotAllowedException(Exception): pass
+class OCMPoolTimeoutException(Exception): pass
+
+NOT_ATTEMPTED = "not attempted: an earlier write in the batch failed"
+PARTIAL_DOC = "partial document - reload() before saving"
+
+# Rows or docs handed to a worker process at a time, see Mgr._hydrate
+PARALLEL_CHUNK = 500
+
+_log = logging.getLogger("ocm")
+
+
+class Pool(object):
+    def __init__(self, host, port, min_size=0, max_size=10, idle_timeout=None, wait_timeout=None,
+                 connect=None):
+        """
+        A pool of pymongo Connections shared by every operation of a Mgr.
+        
+        min_size     - connections opened when the pool is created and kept
+                       open through idle reaping.
+        max_size     - most connections ever checked out at once.  Callers
+                       beyond that wait for one to be checked back in.
+        idle_timeout - seconds an unused connection may sit in the pool
+                       before it is closed.  None = never.
+        wait_timeout - seconds to wait for a free connection before raising
+                       OCMPoolTimeoutException.  None = wait forever.
+        connect      - connect(host, port) makes a connection.  Default is
+                       pymongo's Connection; an in-process fake such as
+                       mongomock can be used for benchmarks.
+        """
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("need 0 <= min_size <= max_size and max_size >= 1")
+        
+        self.host = host
+        self.port = port
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.connect = connect or Connection
+        
+        self._cond = threading.Condition()
+        self._idle = []     # [(conn, time it was checked in)]
+        self._out = 0
+        self._closed = False
+        
+        self.created = 0
+        self.waits = 0
+        
+        for x in range(min_size):
+            self._idle.append((self._connect(), time.time()))
+            
+    def _connect(self):
+        conn = self.connect(self.host, self.port)
+        self._cond.acquire()
+        try:
+            self.created += 1
+        finally:
+            self._cond.release()
+        return conn
+    
+    def _reap(self):
+        # Called with self._cond held.
+        if self.idle_timeout is None:
+            return
+        cutoff = time.time() - self.idle_timeout
+        keep = []
+        for conn, t in self._idle:
+            if t < cutoff and len(keep) + self._out < self.min_size:
+                keep.append((conn, t))
+            elif t < cutoff:
+                conn.disconnect()
+            else:
+                keep.append((conn, t))
+        self._idle = keep
+        
+    def checkout(self):
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise OCMNotAllowedException("pool is closed")
+            self._reap()
+            
+            if not self._idle and self._out >= self.max_size:
+                self.waits += 1
+                if self.wait_timeout is not None:
+                    deadline = time.time() + self.wait_timeout
+                while not self._idle and self._out >= self.max_size:
+                    if self.wait_timeout is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise OCMPoolTimeoutException
+                        self._cond.wait(remaining)
+                    if self._closed:
+                        raise OCMNotAllowedException("pool is closed")
+                    
+            self._out += 1
+            if self._idle:
+                return self._idle.pop()[0]
+        finally:
+            self._cond.release()
+        
+        # Nothing idle, but room to grow.  Connect outside the lock.
+        try:
+            return self._connect()
+        except:
+            self._cond.acquire()
+            try:
+                self._out -= 1
+                self._cond.notify()
+            finally:
+                self._cond.release()
+            raise
+        
+    def checkin(self, conn):
+        self._cond.acquire()
+        try:
+            self._out -= 1
+            if self._closed:
+                conn.disconnect()
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+    
+    def close(self):
+        self._cond.acquire()
+        try:
+            self._closed = True
+            for conn, t in self._idle:
+                conn.disconnect()
+            self._idle = []
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+            
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return {"checked_out": self._out,
+                    "idle": len(self._idle),
+                    "waits": self.waits,
+                    "created": self.created,
+                    "max_size": self.max_size}
+        finally:
+            self._cond.release()
+
+
+class Session(object):
+    """
+    Unit of work opened with Mgr.session().  Documents retrieved, found or
+    saved through the Mgr while it is open are kept by (collection, _id),
+    so asking for one again hands back the same object without a trip to
+    the server.
+    """
+    def __init__(self):
+        self.identity = {}
+        
+    def get(self, collection, _id):
+        return self.identity.get((collection, _id))
+    
+    def add(self, doc):
+        if doc.has_key("_id"):
+            self.identity[(doc.collection, doc["_id"])] = doc
+        
+    def discard(self, doc):
+        if doc.has_key("_id"):
+            self.identity.pop((doc.collection, doc["_id"]), None)
+            
+    def clear(self):
+        self.identity.clear()
+        
+    def forget(self, collection):
+        for key in [k for k in self.identity if k[0] == collection]:
+            del self.identity[key]
+        
+
+class QueryCache(object):
+    def __init__(self, max_size=1000, ttl=60):
+        """
+        Opt-in result cache for a Doc class:
+        
+            class Country(Doc):
+                cache = QueryCache(max_size=500, ttl=300)
+        
+        find() and count() results are kept by their normalized spec for
+        up to ttl seconds (None = until evicted), dropping the least
+        recently used past max_size.  Any save, delete or remove this
+        process makes through a Mgr empties the collection's entries.
+        Writes from other processes aren't seen until ttl runs out.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        _cacheslock.acquire()
+        try:
+            _caches.add(self)
+        finally:
+            _cacheslock.release()
+    
+    def find(self, cls, crit, projection=None, **opts):
+        """
+        Raw rows for crit, from the cache or the server.  The caller
+        gets its own copy to hydrate.  opts are Mgr._find's cursor
+        options.
+        """
+        key = _cachekey(cls.collection, "find", (crit, projection, opts))
+        rows = self._get(key)
+        if rows is _missing:
+            rows = list(cls.mgr._find(cls.collection, crit, projection=projection, **opts))
+            self._put(key, rows)
+        return copy.deepcopy(rows)
+    
+    def count(self, cls, crit):
+        key = _cachekey(cls.collection, "count", crit)
+        n = self._get(key)
+        if n is _missing:
+            n = cls.mgr.count(cls.collection, crit)
+            self._put(key, n)
+        return n
+        
+    def _get(self, key):
+        if key is None:
+            return _missing
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                self.misses += 1
+                return _missing
+            # Back on the end as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+    
+    def _put(self, key, value):
+        if key is None:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        self._lock.acquire()
+        try:
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+            
+    def invalidate(self, collection=None):
+        self._lock.acquire()
+        try:
+            if collection is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == collection]:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+            
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries)}
+
+_caches = weakref.WeakSet()
+_cacheslock = threading.Lock()
+
+def _invalidate(collection):
+    _cacheslock.acquire()
+    try:
+        caches = list(_caches)
+    finally:
+        _cacheslock.release()
+    for c in caches:
+        c.invalidate(collection)
+
+def _cachekey(collection, op, spec):
+    try:
+        key = (collection, op, _freeze(spec))
+        hash(key)
+        return key
+    except TypeError:
+        # Something unhashable in the spec - just don't cache it
+        return None
+
+def _freeze(v):
+    if isinstance(v, dict):
+        return tuple(sorted((k, _freeze(x)) for k, x in v.iteritems()))
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    return v
+
+
+class Index(object):
+    """
+    An index a Doc class's queries rely on.  List them in the class's
+    indexes, and Mgr.ensure_indexes makes any that are missing:
+    
+        indexes = [Index("email", unique=True),
+                   Index([("customer", 1), ("created", -1)]),
+                   Index("expires", ttl=0)]
+    
+    keys   - a field name (ascending), or [(field, 1 or -1), ...]
+    unique - no two docs may have the same keys
+    sparse - leave out docs without the field
+    ttl    - remove docs this many seconds after the (datetime) field
+    name   - default is the name MongoDB would give it, e.g. "customer_1_created_-1"
+    """
+    def __init__(self, keys, unique=False, sparse=False, ttl=None, name=None):
+        if isinstance(keys, basestring):
+            keys = [(keys, 1)]
+        self.keys = list(keys)
+        self.unique = unique
+        self.sparse = sparse
+        self.ttl = ttl
+        self.name = name or "_".join("%s_%s" % (k, d) for k, d in self.keys)
+        
+    def options(self):
+        # As create_index takes them
+        opts = {"name": self.name}
+        if self.unique:
+            opts["unique"] = True
+        if self.sparse:
+            opts["sparse"] = True
+        if self.ttl is not None:
+            opts["expireAfterSeconds"] = self.ttl
+        return opts
+    
+    def matches(self, info):
+        # info is one entry of index_information()
+        return ([tuple(k) for k in info["key"]] == [tuple(k) for k in self.keys] and
+                bool(info.get("unique")) == self.unique and
+                bool(info.get("sparse")) == self.sparse and
+                info.get("expireAfterSeconds") == self.ttl)
+    
+    def __repr__(self):
+        return "Index(%r, %r)" % (self.keys, self.options())
+
+class Listener(object):
+    """
+    Base for Mgr listeners, see Mgr.add_listener.  Override what you
+    need.  Each server operation calls started(), then succeeded() or
+    failed(), with the same event dict:
+    
+        op          - "find", "retrieve", "count", "save", "insert",
+                      "update", "delete", "remove" or "nextval"
+        collection  - collection name
+        shape       - the query spec with literal values left out, see _shape
+        docs        - documents returned, or written / removed
+        bytes       - BSON size of the documents returned or sent
+        duration_ms - once finished
+        error       - failed() only, the exception
+    
+    A find is finished when its cursor has been read to the end (or
+    given up on), so duration_ms includes the time spent hydrating.
+    
+    Listeners run on the thread doing the operation and hold it up, so
+    keep them quick.  An exception from one is logged, not raised.
+    """
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        pass
+    
+    def failed(self, event):
+        pass
+
+
+class SlowQueryLogger(Listener):
+    """
+    Keeps the last max_entries operations that took threshold_ms or
+    longer, and logs each one as a warning on the "ocm" logger.  Only
+    the shape of the query is kept, never its values:
+    
+        slow = SlowQueryLogger(threshold_ms=50)
+        mgr.add_listener(slow)
+        ...
+        for s in slow.summary():
+            print s
+    """
+    def __init__(self, threshold_ms=100, max_entries=1000, logger=None):
+        self.threshold_ms = threshold_ms
+        self.entries = deque(maxlen=max_entries)
+        self.log = logger or _log
+    
+    def succeeded(self, event):
+        self._check(event)
+    
+    def failed(self, event):
+        self._check(event)
+    
+    def _check(self, event):
+        if event["duration_ms"] < self.threshold_ms:
+            return
+        entry = {"op": event["op"], 
+                 "collection": event["collection"],
+                 "shape": event["shape"],
+                 "duration_ms": event["duration_ms"],
+                 "docs": event["docs"],
+                 "failed": event.has_key("error")}
+        self.entries.append(entry)
+        self.log.warning("slow %s on %s %s: %.1f ms, %d docs", entry["op"],
+                         entry["collection"], entry["shape"], entry["duration_ms"], 
+                         entry["docs"])
+    
+    def summary(self):
+        """
+        The kept entries grouped by op, collection and shape, worst total
+        time first, as [{"op", "collection", "shape", "count", "total_ms",
+        "max_ms"}].
+        """
+        groups = {}
+        for e in list(self.entries):
+            key = (e["op"], e["collection"], e["shape"])
+            g = groups.get(key)
+            if g is None:
+                g = groups[key] = {"op": e["op"], "collection": e["collection"],
+                                   "shape": e["shape"], "count": 0, 
+                                   "total_ms": 0.0, "max_ms": 0.0}
+            g["count"] += 1
+            g["total_ms"] += e["duration_ms"]
+            g["max_ms"] = max(g["max_ms"], e["duration_ms"])
+        return sorted(groups.values(), key=lambda g: -g["total_ms"])
+
+def _shape(spec):
+    """
+    spec with every literal value replaced by ?, as a string that is the
+    same for every query of that shape:
+    
+        {"age": {"$gt": 30}, "name": "x"}  ->  {age: {$gt: ?}, name: ?}
+    """
+    if not spec:
+        return "{}"
+    return "{%s}" % ", ".join("%s: %s" % (k, _shapeval(k, spec[k])) 
+                              for k in sorted(spec))
+
+def _shapeval(k, v):
+    if isinstance(v, dict):
+        return _shape(v)
+    if k in ("$and", "$or", "$nor") and isinstance(v, list):
+        return "[%s]" % ", ".join(_shape(x) for x in v)
+    return "?"
+
+def _bsonsize(docs):
+    n = 0
+    for d in docs:
+        n += len(BSON.encode(d))
+    return n
+
+class Profile(object):
+    """
+    Wall clock time and calls per phase and per Doc class, see profile().
+    The phases are
+    
+        network  - waiting on the server, including the driver decoding
+                   BSON as the cursor is read
+        hydrate  - Doc.new filling in defaults and converting values
+        validate - field checks
+        hooks    - validate(), before_save, after_save, before_del and
+                   after_del overrides
+    
+    Times are exclusive: a nested doc's hydration counts for its own
+    class, not the one it is in, and a find() a hook makes counts as
+    network.  Network time for calls that aren't made for a Doc class
+    (e.g. Mgr.count) is under the collection name, sequences under
+    "sequences".
+    """
+    PHASES = ("network", "hydrate", "validate", "hooks")
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+    
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._totals = {}     # (phase, name) -> [calls, seconds]
+        finally:
+            self._lock.release()
+    
+    def push(self, phase, name):
+        # Start timing phase, pausing the one this thread was in
+        now = time.time()
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        if stack:
+            top = stack[-1]
+            self._add(top[0], top[1], 0, now - top[2])
+        stack.append([phase, name, now])
+    
+    def pop(self, calls=1):
+        now = time.time()
+        stack = self._local.stack
+        top = stack.pop()
+        self._add(top[0], top[1], calls, now - top[2])
+        if stack:
+            stack[-1][2] = now
+    
+    def _add(self, phase, name, calls, seconds):
+        self._lock.acquire()
+        try:
+            t = self._totals.get((phase, name))
+            if t is None:
+                t = self._totals[(phase, name)] = [0, 0.0]
+            t[0] += calls
+            t[1] += seconds
+        finally:
+            self._lock.release()
+    
+    def report(self):
+        """
+        {phase: {class name: {"calls": n, "total_ms": ms}}}
+        """
+        self._lock.acquire()
+        try:
+            totals = dict((k, list(v)) for k, v in self._totals.iteritems())
+        finally:
+            self._lock.release()
+        
+        report = {}
+        for (phase, name), (calls, seconds) in totals.iteritems():
+            report.setdefault(phase, {})[name] = {"calls": calls, 
+                                                  "total_ms": seconds * 1000}
+        return report
+    
+    def table(self):
+        """
+        The report as text, one line per phase and class, most time first.
+        """
+        rows = []
+        for phase, byname in self.report().iteritems():
+            for name, r in byname.iteritems():
+                rows.append((phase, name, r["calls"], r["total_ms"]))
+        rows.sort(key=lambda r: -r[3])
+        total = sum(r[3] for r in rows) or 1.0
+        
+        lines = ["%-9s %-20s %8s %12s %10s %6s" % ("phase", "class", "calls", 
+                                                   "total ms", "avg ms", "%")]
+        for phase, name, calls, ms in rows:
+            lines.append("%-9s %-20s %8d %12.2f %10.3f %5.1f%%" % (
+                         phase, name, calls, ms, ms / max(calls, 1), 100 * ms / total))
+        return "\n".join(lines)
+    
+    def __str__(self):
+        return self.table()
+
+# How many Profiles are recording.  Hot paths test this before anything
+# else, so profiling costs next to nothing while it is off.
+_profiling = 0
+_profiles = []           # open profile()s with no mgr, newest last
+_proflock = threading.Lock()
+
+class _Tee(object):
+    # Records into a profile() block and a Mgr's own Profile at once
+    def __init__(self, *profiles):
+        self.profiles = profiles
+    
+    def push(self, phase, name):
+        for p in self.profiles:
+            p.push(phase, name)
+    
+    def pop(self, calls=1):
+        for p in self.profiles:
+            p.pop(calls)
+
+def _profiler(mgr):
+    # What to record mgr's work in, if anything
+    mine = getattr(mgr, "_profile", None)
+    if _profiles:
+        try:
+            p = _profiles[-1]
+        except IndexError:
+            # closed by another thread just now
+            return mine
+        if mine is None:
+            return p
+        return _Tee(p, mine)
+    return mine
+
+def _profiled(delta):
+    global _profiling
+    _proflock.acquire()
+    try:
+        _profiling += delta
+    finally:
+        _proflock.release()
+
+def _clsname(o):
+    # Mgr calls take a Doc class, or for old callers an instance
+    if isinstance(o, type):
+        return o.__name__
+    return type(o).__name__
+
+def _timedrows(prof, name, cursor):
+    # cursor's rows, with the wait for each one counted as network - one
+    # call for the whole cursor
+    if prof is None:
+        for i in cursor:
+            yield i
+        return
+    it = iter(cursor)
+    calls = 1
+    while True:
+        prof.push("network", name)
+        try:
+            i = next(it)
+        except StopIteration:
+            return
+        finally:
+            prof.pop(calls)
+            calls = 0
+        yield i
+
+def _timed(prof, phase, name, fn, *args):
+    if prof is None:
+        return fn(*args)
+    prof.push(phase, name)
+    try:
+        return fn(*args)
+    finally:
+        prof.pop()
+
+@contextmanager
+def profile(mgr=None):
+    """
+    Time where the work goes, per phase and Doc class:
+    
+        with ocm.profile() as p:
+            Order.find({"status": "open"})
+        print p.table()
+    
+    With no mgr every Mgr's work in every thread is recorded, in the
+    newest such block still open.  Given a mgr, only that one's - see
+    also Mgr.start_profile.  Work a Mgr's own profile is recording goes
+    to both.
+    """
+    if mgr is not None:
+        p = mgr.start_profile()
+        try:
+            yield p
+        finally:
+            mgr.stop_profile()
+        return
+    
+    p = Profile()
+    _proflock.acquire()
+    _profiles.append(p)
+    _proflock.release()
+    _profiled(1)
+    try:
+        yield p
+    finally:
+        # Blocks in different threads can close in any order
+        _proflock.acquire()
+        _profiles.remove(p)
+        _proflock.release()
+        _profiled(-1)
+
+# _nextval looks sequences up by name, and two first-time upserts could
+# otherwise both insert.
+SEQUENCE_INDEX = Index("seqname", unique=True)
+
 
 class Mgr(object):
 #    Put connection variable/info here
@@ -13,129 +712,811 @@ class Mgr(object):
 # 
 #    Also little nice-ities like a switch allowing
 #    full 'remove's, etc.
-    def __init__(self, host, port, db):
+    def __init__(self, host, port, db, min_pool_size=0, max_pool_size=10,
+                 idle_timeout=None, wait_timeout=None, connect=None):
         self.host = host
         self.port = port
         self.db = db
-    def _getConn(self):
-        conn = Connection(self.host, self.port)
-        return conn[self.db]
+        
+        self.min_pool_size = min_pool_size
+        self.max_pool_size = max_pool_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.connect = connect
+        
+        self._pool = None
+        self._poollock = threading.Lock()
+        
+        # seqname -> [next value to hand out, last value reserved]
+        self._seqblocks = {}
+        self._seqlock = threading.Lock()
+        self._seqindexed = False
+        
+        self._local = threading.local()
+        self._async = None
+        self._listeners = []
+        self._profile = None
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        return False
+    
+    def pool(self):
+        # Made on first use so that declaring a Doc class with a Mgr
+        # doesn't open any sockets.
+        if self._pool is None:
+            self._poollock.acquire()
+            try:
+                if self._pool is None:
+                    self._pool = Pool(self.host, self.port,
+                                      min_size=self.min_pool_size,
+                                      max_size=self.max_pool_size,
+                                      idle_timeout=self.idle_timeout,
+                                      wait_timeout=self.wait_timeout,
+                                      connect=self.connect)
+            finally:
+                self._poollock.release()
+        return self._pool
+    
+    def pool_stats(self):
+        if self._pool is None:
+            return {"checked_out": 0, "idle": 0, "waits": 0, "created": 0,
+                    "max_size": self.max_pool_size}
+        return self._pool.stats()
+    
+    def close(self):
+        """
+        Close every pooled connection.  The Mgr stays usable - the next
+        operation starts a fresh pool.
+        """
+        self._poollock.acquire()
+        try:
+            pool, self._pool = self._pool, None
+        finally:
+            self._poollock.release()
+        if pool:
+            pool.close()
+        
+        self._poollock.acquire()
+        try:
+            amgr, self._async = self._async, None
+        finally:
+            self._poollock.release()
+        if amgr:
+            amgr.close()
+    
+    def add_listener(self, listener):
+        """
+        Have listener told about every operation sent to the server, see
+        Listener.
+        """
+        self._poollock.acquire()
+        try:
+            self._listeners = self._listeners + [listener]
+        finally:
+            self._poollock.release()
+    
+    def remove_listener(self, listener):
+        self._poollock.acquire()
+        try:
+            self._listeners = [l for l in self._listeners if l is not listener]
+        finally:
+            self._poollock.release()
+    
+    def start_profile(self):
+        """
+        Record where this Mgr's time goes until stop_profile(), e.g. from
+        an admin page.  Returns the Profile, see profile().
+        """
+        self._poollock.acquire()
+        try:
+            if self._profile is None:
+                self._profile = Profile()
+                _profiled(1)
+            return self._profile
+        finally:
+            self._poollock.release()
+    
+    def stop_profile(self):
+        self._poollock.acquire()
+        try:
+            p, self._profile = self._profile, None
+            if p is not None:
+                _profiled(-1)
+            return p
+        finally:
+            self._poollock.release()
+    
+    @contextmanager
+    def _op(self, op, collection, spec=None, name=None, timed=True):
+        # One server operation, for the listeners and profiling.  Yields
+        # the event, or None when nobody is listening, for the body to
+        # fill in docs and bytes.  name is the Doc class's, for profiling,
+        # and timed=False leaves timing the network to the body.
+        listeners = self._listeners
+        prof = None
+        if _profiling and timed:
+            prof = _profiler(self)
+        
+        if prof is not None:
+            prof.push("network", name or collection)
+        try:
+            if listeners:
+                with self._notify(listeners, op, collection, spec) as event:
+                    yield event
+            else:
+                yield None
+        finally:
+            if prof is not None:
+                prof.pop()
+    
+    @contextmanager
+    def _notify(self, listeners, op, collection, spec):
+        event = {"op": op, "collection": collection, "shape": _shape(spec), 
+                 "docs": 0, "bytes": 0}
+        self._emit(listeners, "started", event)
+        start = time.time()
+        try:
+            yield event
+        except GeneratorExit:
+            # A cursor that wasn't read to the end
+            event["duration_ms"] = (time.time() - start) * 1000
+            self._emit(listeners, "succeeded", event)
+            raise
+        except Exception, e:
+            event["duration_ms"] = (time.time() - start) * 1000
+            event["error"] = e
+            self._emit(listeners, "failed", event)
+            raise
+        event["duration_ms"] = (time.time() - start) * 1000
+        self._emit(listeners, "succeeded", event)
+    
+    @staticmethod
+    def _emit(listeners, what, event):
+        for l in listeners:
+            try:
+                getattr(l, what)(event)
+            except Exception:
+                _log.exception("listener %r failed", l)
+    
+    def asyncmgr(self):
+        """
+        The AsyncMgr shared by this Mgr's Doc classes (save_async etc),
+        made on first use.
+        """
+        if self._async is None:
+            self._poollock.acquire()
+            try:
+                if self._async is None:
+                    self._async = AsyncMgr(self)
+            finally:
+                self._poollock.release()
+        return self._async
+    
+    @contextmanager
+    def session(self):
+        """
+        with mgr.session() as s:
+            ...
+        
+        Opens a Session for the current thread.  Sessions nest; the outer
+        one comes back when the inner one closes.
+        """
+        outer = self._session()
+        s = Session()
+        self._local.session = s
+        try:
+            yield s
+        finally:
+            self._local.session = outer
+    
+    def _session(self):
+        return getattr(self._local, "session", None)
+    
+    @contextmanager
+    def _db(self):
+        pool = self.pool()
+        conn = pool.checkout()
+        try:
+            yield conn[self.db]
+        finally:
+            pool.checkin(conn)
+            
+    @contextmanager
+    def _coll(self, name):
+        with self._db() as mdb:
+            yield mdb[name]
     
     # Upsert functionality
     def save(self, obj):
+        """
+        Docs that came from the server, or were saved before, only send
+        the fields changed since then ($set/$unset), and nothing at all
+        if none were.  Others are written whole.
+        """
+        if obj._changes() == {}:
+            return True
         
-        conn = Connection(self.host, self.port)
-        mdb = conn[self.db]
-        coll = mdb[obj.collection]
-        
-        coll.save(obj)
+        with self._coll(obj.collection) as coll:
+            self._write(coll, obj)
+        _invalidate(obj.collection)
         
+        session = self._session()
+        if session:
+            session.add(obj)
         return True
+    
+    def save_many(self, objs, batch_size=1000, ordered=True):
+        """
+        Write a batch of documents with as few round trips as possible.
+        New documents (no _id yet) go out in inserts of up to batch_size
+        documents; ones that already have an _id are upserted one by one.
+        
+        ordered - stop at the first failed write, like a single save()
+                  loop would.  With ordered=False every batch is attempted
+                  and the server keeps going past failures inside one.
+        
+        Returns a list with one entry per obj: None if it was written,
+        otherwise a message saying why not.
+        """
+        results = [None] * len(objs)
+        with self._db() as mdb:
+            for chunk in self._chunks(objs, batch_size):
+                first = objs[chunk[0]]
+                coll = mdb[first.collection]
+                if first.has_key("_id"):
+                    failed = self._save_each(coll, objs, chunk, results, ordered)
+                else:
+                    failed = self._insert_batch(coll, objs, chunk, results, ordered)
+                
+                if failed and ordered:
+                    for i in range(chunk[-1] + 1, len(objs)):
+                        results[i] = NOT_ATTEMPTED
+                    break
+        
+        for collection in set(o.collection for o in objs):
+            _invalidate(collection)
+        
+        session = self._session()
+        if session:
+            for o, r in zip(objs, results):
+                if r is None:
+                    session.add(o)
+        return results
+    
+    def _write(self, coll, obj, **kw):
+        changes = obj._changes()
+        with self._op("save", coll.name, {"_id": obj.get("_id")}, type(obj).__name__) as ev:
+            if changes is None:
+                coll.save(obj, **kw)
+            elif changes:
+                coll.update({"_id": obj["_id"]}, changes, **kw)
+            if ev:
+                ev["docs"] = 1
+                ev["bytes"] = _bsonsize([changes or obj])
+        obj._clean()
+    
+    @staticmethod
+    def _chunks(objs, batch_size):
+        # Runs of up to batch_size indexes sharing a collection and
+        # agreeing on whether they are new.
+        chunk = []
+        for i, o in enumerate(objs):
+            if chunk:
+                prev = objs[chunk[-1]]
+                if (len(chunk) >= batch_size or 
+                    prev.collection != o.collection or
+                    prev.has_key("_id") != o.has_key("_id")):
+                    yield chunk
+                    chunk = []
+            chunk.append(i)
+        if chunk:
+            yield chunk
+    
+    def _save_each(self, coll, objs, chunk, results, ordered):
+        failed = False
+        for i in chunk:
+            if failed and ordered:
+                results[i] = NOT_ATTEMPTED
+                continue
+            try:
+                self._write(coll, objs[i], safe=True)
+            except OperationFailure, e:
+                results[i] = str(e)
+                failed = True
+        return failed
+    
+    def _insert_batch(self, coll, objs, chunk, results, ordered):
+        docs = [objs[i] for i in chunk]
+        try:
+            with self._op("insert", coll.name, name=type(docs[0]).__name__) as ev:
+                if ev:
+                    ev["docs"] = len(docs)
+                    ev["bytes"] = _bsonsize(docs)
+                coll.insert(docs, safe=True, continue_on_error=not ordered)
+            for d in docs:
+                d._clean()
+            return False
+        except OperationFailure, e:
+            # The driver gave every doc an _id before sending, so ask the
+            # server which of them actually made it.
+            ids = [d["_id"] for d in docs if d.has_key("_id")]
+            written = set(x["_id"] for x in coll.find({"_id": {"$in": ids}}, fields=["_id"]))
+            
+            reported = False
+            for i in chunk:
+                if objs[i].get("_id") in written:
+                    objs[i]._clean()
+                    continue
+                # Not stored - don't let it look persisted.
+                dict.__delitem__(objs[i], "_id")
+                if ordered and reported:
+                    results[i] = NOT_ATTEMPTED
+                else:
+                    results[i] = str(e)
+                    reported = True
+            return True
  
     # Server side.
-    def update(self, spec):
-        return "update! ", spec
+    def update(self, cls, criteria, changes, multi=False, upsert=False):
+        """
+        Apply update operators ($set, $inc, $push, ...) on the server to
+        the docs of cls matching criteria - the first one, or all with
+        multi=True.  Values are coerced to their field types first, see
+        Doc._makeNiceChanges.
+        
+        Returns {"matched": n, "modified": n}.
+        """
+        changes = cls._makeNiceChanges(changes)
+        with self._coll(cls.collection) as coll:
+            with self._op("update", cls.collection, criteria, _clsname(cls)) as ev:
+                rslt = coll.update(criteria or {}, changes, upsert=upsert, multi=multi, safe=True)
+                if ev:
+                    ev["docs"] = rslt.get("n", 0)
+                    ev["bytes"] = _bsonsize([changes])
+        self._written(cls.collection)
+        
+        matched = rslt.get("n", 0)
+        return {"matched": matched,
+                "modified": rslt.get("nModified", matched)}
+    
+    def _written(self, collection):
+        # Whatever was cached or mapped for the collection may be stale
+        _invalidate(collection)
+        session = self._session()
+        if session:
+            session.forget(collection)
     
      
     def delete(self, obj):
 #        print "here in Mgr.delete)"
 #        return "delete! ", obj
         # really, do a remove obj.spec, then invalidate obj in some way (? = None)
-        conn = Connection(self.host, self.port)
-        mdb = conn[self.db]
-        coll = mdb[obj.collection]
+        with self._coll(obj.collection) as coll:
+            if obj.has_key("_id"):
+                sp = { "_id": obj._id, "$atomic": True}
+            else:
+                sp = obj
+            with self._op("delete", obj.collection, sp, type(obj).__name__):
+                coll.remove(sp)
+        # No longer stored, so the next save writes it whole
+        obj.__dict__.pop("_persisted", None)
+        _invalidate(obj.collection)
         
-        if obj.has_key("_id"):
-            sp = { "_id": obj._id, "$atomic": True}
-            coll.remove(sp)
-        else:
-            coll.remove(obj)
+        session = self._session()
+        if session:
+            session.discard(obj)
             
 #        print "in delete: ", coll.find().count()
             
         
-    def remove(self, criteria=None):
-        if not criteria:
+    def remove(self, cls, criteria=None, confirmNoCriteria=False, hooks=True, batch_size=1000):
+        """
+        Remove every doc of cls matching criteria on the server, returning
+        how many went.  Empty criteria would wipe the collection, so that
+        takes confirmNoCriteria=True.
+        
+        If cls overrides before_del or after_del (and hooks is on), the
+        docs are fetched batch_size at a time so the hooks can be run on
+        them, before_del returning False keeping a doc.  Otherwise it is
+        a single remove on the server.
+        """
+        if not criteria and not confirmNoCriteria:
             raise OCMNotAllowedException
+        criteria = criteria or {}
+        
+        if hooks and cls._has_del_hooks():
+            n = self._remove_with_hooks(cls, criteria, batch_size)
+        else:
+            with self._coll(cls.collection) as coll:
+                with self._op("remove", cls.collection, criteria, _clsname(cls)) as ev:
+                    n = coll.remove(criteria, safe=True).get("n", 0)
+                    if ev:
+                        ev["docs"] = n
         
-        return "blah!"
+        self._written(cls.collection)
+        return n
+    
+    def delete_ids(self, cls, ids, hooks=True, batch_size=1000):
+        """
+        Remove the docs of cls with the given _ids - remove() by $in.
+        """
+        ids = list(ids)
+        if not ids:
+            return 0
+        return self.remove(cls, {"_id": {"$in": ids}}, hooks=hooks, batch_size=batch_size)
+    
+    def _remove_with_hooks(self, cls, criteria, batch_size):
+        ids = [r["_id"] for r in self._find(cls.collection, criteria, projection=["_id"])]
+        
+        n = 0
+        for start in range(0, len(ids), batch_size):
+            docs = self.get(cls, {"_id": {"$in": ids[start:start + batch_size]}})
+            prof = None
+            if _profiling:
+                prof = _profiler(self)
+            docs = [d for d in docs if _timed(prof, "hooks", _clsname(cls), d.before_del, d) 
+                                       is not False]
+            if not docs:
+                continue
+            
+            spec = {"_id": {"$in": [d["_id"] for d in docs]}}
+            with self._coll(cls.collection) as coll:
+                with self._op("remove", cls.collection, spec, _clsname(cls)) as ev:
+                    removed = coll.remove(spec, safe=True).get("n", 0)
+                    if ev:
+                        ev["docs"] = removed
+                n += removed
+            for d in docs:
+                d.__dict__.pop("_persisted", None)
+                _timed(prof, "hooks", _clsname(cls), d.after_del, d)
+        return n
     
     # find_one -vs- find ?  multiple results need to be in a list
     # Right now, support either All, or field = val.
-    def get(self, cls, criteria=None):
-        conn = Connection(self.host, self.port)
-        mdb = conn[self.db]
-        coll = mdb[cls.collection]
-        
-        x = []
-#        if criteria:
-        for i in coll.find(criteria):
-            x.append(cls.new(i))
-#        else:
-#            for i in coll.find(criteria):
-#                x.append(obj.new(i))
-        return x
-    
-    def retrieve(self, obj, criteria=None):
-        conn = Connection(self.host, self.port)
-        mdb = conn[self.db]
-        coll = mdb[obj.collection]
-#        print "db: ", self.db
-#        print "coll: ", obj.collection
+    def get(self, cls, criteria=None, projection=None, sort=None, limit=None,
+            skip=None, hint=None, max_time_ms=None, workers=None):
+        """
+        All of these are done by the server:
+        
+        projection  - list of field names to fetch.  The docs that come
+                      back are partial: see Doc.new.
+        sort        - a field name, or [(field, 1 or -1), ...]
+        limit, skip - how many docs to return / pass over first
+        hint        - index to use, by name or [(field, direction), ...]
+        max_time_ms - give up on the query after this long
+        
+        workers     - hydrate the rows in this many processes, for big
+                      results.  See _hydrate.
+        """
+        return list(self.iter_get(cls, criteria, projection=projection, sort=sort,
+                                  limit=limit, skip=skip, hint=hint,
+                                  max_time_ms=max_time_ms, workers=workers))
+    
+    def iter_get(self, cls, criteria=None, batch_size=None, projection=None, sort=None,
+                 limit=None, skip=None, hint=None, max_time_ms=None, workers=None):
+        """
+        Like get(), but yields each document as the cursor delivers it
+        instead of building the whole list first.  batch_size sets how
+        many rows the server sends per round trip.
         
+        The pooled connection is held until the iterator is exhausted or
+        closed, so don't leave one half read for long.
+        """
+        rows = self._find(cls.collection, criteria, batch_size, projection, sort=sort,
+                          limit=limit, skip=skip, hint=hint, max_time_ms=max_time_ms,
+                          name=_clsname(cls))
+        return self._hydrate(cls, rows, projection, workers)
+    
+    def _find(self, collectionName, criteria=None, batch_size=None, projection=None,
+              sort=None, limit=None, skip=None, hint=None, max_time_ms=None, name=None):
+        # Raw rows, straight off the cursor
+        with self._coll(collectionName) as coll:
+            cursor = coll.find(criteria, fields=projection)
+            if sort:
+                if isinstance(sort, basestring):
+                    sort = [(sort, 1)]
+                cursor = cursor.sort(sort)
+            if skip:
+                cursor = cursor.skip(skip)
+            if limit:
+                cursor = cursor.limit(limit)
+            if hint:
+                cursor = cursor.hint(hint)
+            if max_time_ms:
+                cursor = cursor.max_time_ms(max_time_ms)
+            if batch_size:
+                cursor = cursor.batch_size(batch_size)
+            prof = None
+            if _profiling:
+                prof = _profiler(self)
+                cursor = _timedrows(prof, name or collectionName, cursor)
+            
+            with self._op("find", collectionName, criteria, timed=False) as ev:
+                if ev is None:
+                    for i in cursor:
+                        yield i
+                else:
+                    for i in cursor:
+                        ev["docs"] += 1
+                        ev["bytes"] += len(BSON.encode(i))
+                        yield i
+    
+    def _hydrate(self, cls, rows, projection=None, workers=None):
+        """
+        Docs from raw rows, in order.
         
+        workers - more than 1 sends the rows, PARALLEL_CHUNK at a time, to
+                  that many processes to be made into docs (new() and
+                  validation), and takes them back in order as they are
+                  done.  Only worth it for thousands of rows.  cls must
+                  be importable by its module path, i.e. not defined
+                  inside a function.
+        """
+        if workers > 1:
+            rows = _parallel(_hydrate_chunk, cls, rows, (cls, projection), workers)
+        
+        session = self._session()
+        for i in rows:
+            if session:
+                yield self._identify(session, cls, i, projection)
+            elif isinstance(i, cls):
+                yield i
+            else:
+                yield cls.new(i, loaded=projection)._clean()
+                    
+    def _identify(self, session, cls, row, projection=None):
+        # The session's copy if it has one, otherwise hydrate and keep it.
+        # Partial docs aren't kept - they'd stand in for whole ones later.
+        d = session.get(cls.collection, row.get("_id"))
+        if d is None:
+            d = row
+            if not isinstance(d, cls):
+                d = cls.new(row, loaded=projection)._clean()
+            if projection is None:
+                session.add(d)
+        return d
+    
+    def retrieve(self, obj, criteria=None, projection=None):
         if criteria:
-#            print "retrieve crit: ", criteria
             if isinstance(criteria, dict):
-#                print "crit is dict"
                 spec = criteria
             else:
-#                print "crit is not dict"
                 spec = dict(criteria)
         else:
-#            print "no crit supplied"
             spec = {}
             
-#        print "spec: ", spec
-        
-        mob = coll.find_one(spec)
-#        print "mob: ", mob
-        return obj.new(mob)      
+        session = self._session()
+        if (session and spec.keys() == ["_id"] and 
+            not isinstance(spec["_id"], (dict, list))):
+            # A plain _id, not an operator like {"$in": [...]}
+            d = session.get(obj.collection, spec["_id"])
+            if d is not None:
+                return d
+            
+        with self._coll(obj.collection) as coll:
+            with self._op("retrieve", obj.collection, spec, _clsname(obj)) as ev:
+                mob = coll.find_one(spec, fields=projection)
+                if ev and mob:
+                    ev["docs"] = 1
+                    ev["bytes"] = _bsonsize([mob])
+            
+        if session and mob:
+            return self._identify(session, obj, mob, projection)
+        d = obj.new(mob, loaded=projection)
+        if mob:
+            d._clean()
+        return d
         
         
     def count(self, collectionName, criteria=None):
-        conn = Connection(self.host, self.port)
-        mdb = conn[self.db]
-        coll = mdb[collectionName]
-        return coll.find(criteria).count()
-        
-    def _nextval(self, seqname, retries=100):
-        # TODO: retries is gawky! must be a better way.
-        conn = Connection(self.host, self.port)
-        mdb = conn[self.db]
-        coll = mdb.sequences
-
-        obj = coll.find_one( {"seqname": seqname, "lastval" : { "$gte" : 0}} )
-
-        # Create a new sequence if need be
-#        if 0 == len(obj):
-        if not obj:
-            coll.save({"seqname": seqname, "lastval": 1})
-#            obj = coll.find_one( {"seqname": seqname, "lastval" : { "$gte" : 1}} )
-            return 1
-        
-        v = obj["lastval"]
-        vnew = v
-        r = 0
-        while (1 and r < retries):
-            vnew += 1
-            coll.update( { "seqname": seqname, "lastval": v }, { "$set": {"lastval": vnew} } );
-            rslt = mdb.command({"getlasterror":1})
-            if rslt["updatedExisting"]:
-                break
-            r += 1
+        with self._coll(collectionName) as coll:
+            with self._op("count", collectionName, criteria):
+                return coll.find(criteria).count()
+    
+    def _declared(self, classes):
+        # collection -> the Indexes declared for it, sequences included
+        declared = OrderedDict([("sequences", [SEQUENCE_INDEX])])
+        for cls in classes:
+            l = declared.setdefault(cls.collection, [])
+            for idx in cls.indexes:
+                if idx.name not in [i.name for i in l]:
+                    l.append(idx)
+        return declared
+    
+    def ensure_indexes(self, *classes):
+        """
+        Make the indexes the given Doc classes declare, plus the one on
+        sequences.seqname, where they don't exist yet.  Safe to call on
+        every start up.  Returns [(collection, index name)] of the ones
+        it made.
+        
+        An index that exists under the same name with different keys or
+        options is left alone - see index_drift.
+        """
+        made = []
+        for collection, declared in self._declared(classes).iteritems():
+            with self._coll(collection) as coll:
+                have = coll.index_information()
+                for idx in declared:
+                    if not have.has_key(idx.name):
+                        coll.create_index(idx.keys, **idx.options())
+                        made.append((collection, idx.name))
+        self._seqindexed = True
+        return made
+    
+    def index_drift(self, *classes):
+        """
+        How the server's indexes differ from what the given Doc classes
+        declare, as
+        
+            {collection: {"missing": [names], "changed": [names], "extra": [names]}}
+        
+        missing - declared, not on the server
+        changed - on the server under that name, but with other keys or options
+        extra   - on the server, not declared (_id's own index isn't counted)
         
-        return vnew
+        Collections that match are left out, so {} means no drift.
+        """
+        drift = {}
+        for collection, declared in self._declared(classes).iteritems():
+            with self._coll(collection) as coll:
+                have = coll.index_information()
+            
+            names = set(i.name for i in declared)
+            d = {"missing": [i.name for i in declared if not have.has_key(i.name)],
+                 "changed": [i.name for i in declared 
+                             if have.has_key(i.name) and not i.matches(have[i.name])],
+                 "extra": sorted(n for n in have if n not in names and n != "_id_")}
+            if d["missing"] or d["changed"] or d["extra"]:
+                drift[collection] = d
+        return drift
+        
+    def _nextval(self, seqname, retries=100, block_size=1):
+        """
+        Next value of the named sequence.
+        
+        With block_size > 1 a whole range of values is reserved on the
+        server at once and handed out from memory until it runs dry.
+        Values left in a block when the Mgr goes away are never used, so
+        sequences can have gaps.
+        """
+        if block_size <= 1:
+            return self._reserve(seqname, 1, retries)
+        
+        self._seqlock.acquire()
+        try:
+            block = self._seqblocks.get(seqname)
+            if not block or block[0] > block[1]:
+                last = self._reserve(seqname, block_size, retries)
+                block = [last - block_size + 1, last]
+                self._seqblocks[seqname] = block
+            v = block[0]
+            block[0] += 1
+            return v
+        finally:
+            self._seqlock.release()
+    
+    def _reserve(self, seqname, n, retries=100):
+        # Move lastval up by n in one findAndModify, returning the new
+        # lastval.  The upsert makes the sequence on first use.
+        with self._db() as mdb:
+            coll = mdb.sequences
+            if not self._seqindexed:
+                self._seqindexed = True
+                try:
+                    coll.create_index(SEQUENCE_INDEX.keys, **SEQUENCE_INDEX.options())
+                except OperationFailure, e:
+                    # Most likely duplicate sequence docs left by older
+                    # versions.  findAndModify still works on them, so
+                    # don't stop saves over it; ensure_indexes will fail
+                    # loudly until they are cleaned up.
+                    _log.warning("can't make the unique index on sequences.seqname, "
+                                 "sequences may hand out duplicates: %s", e)
+            
+            r = 0
+            while True:
+                try:
+                    with self._op("nextval", "sequences", {"seqname": seqname}):
+                        obj = coll.find_and_modify({"seqname": seqname},
+                                                   {"$inc": {"lastval": n}},
+                                                   upsert=True, new=True)
+                    return obj["lastval"]
+                except DuplicateKeyError:
+                    # Lost the race to create it - it exists now.
+                    r += 1
+                    if r >= retries:
+                        raise
+
+
+class AsyncMgr(object):
+    """
+    Runs a Mgr's blocking calls on a pool of worker threads and hands
+    back concurrent.futures Futures, so one process can keep many
+    requests in flight without waiting on each socket in turn:
+    
+        amgr = AsyncMgr(mgr)
+        f = amgr.get(Order, {"status": "open"})
+        ...
+        orders = f.result()
+    
+    Each call runs on whichever worker is free, so mgr.session() in the
+    calling thread doesn't cover it.
+    
+    mgr     - the Mgr to run calls on
+    workers - number of threads, default mgr.max_pool_size.  More than
+              that just queues up in the connection pool.
+    """
+    def __init__(self, mgr, workers=None):
+        if ThreadPoolExecutor is None:
+            raise OCMNotAllowedException("AsyncMgr needs concurrent.futures - pip install futures")
+        self.mgr = mgr
+        self.workers = workers or mgr.max_pool_size
+        self._executor = ThreadPoolExecutor(self.workers)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        return False
+    
+    def close(self, wait=True):
+        """
+        Stop taking new calls.  wait=True blocks until the queued ones
+        are done.
+        """
+        self._executor.shutdown(wait)
+    
+    def submit(self, fn, *args, **kw):
+        # Any blocking call, e.g. amgr.submit(Order.find, crit, limit=20)
+        return self._executor.submit(fn, *args, **kw)
+    
+    def save(self, obj):
+        return self.submit(self.mgr.save, obj)
+    
+    def get(self, cls, criteria=None, **kw):
+        # kw as for Mgr.get
+        return self.submit(self.mgr.get, cls, criteria, **kw)
+    
+    def iter_get(self, cls, criteria=None, batch_size=100, **kw):
+        """
+        Yields a future per batch of up to batch_size docs, so a big
+        result can be worked on as it arrives:
+        
+            for f in amgr.iter_get(Order, crit):
+                for o in f.result():
+                    ...
+        
+        Each batch is only asked for once the one before it has come
+        back.
+        """
+        it = self.mgr.iter_get(cls, criteria, batch_size=batch_size, **kw)
+        def batch():
+            docs = []
+            for o in it:
+                docs.append(o)
+                if len(docs) == batch_size:
+                    break
+            return docs
+        
+        while True:
+            f = self.submit(batch)
+            yield f
+            if len(f.result()) < batch_size:
+                break
+    
+    def retrieve(self, obj, criteria=None, projection=None):
+        return self.submit(self.mgr.retrieve, obj, criteria, projection)
+    
+    def count(self, collectionName, criteria=None):
+        return self.submit(self.mgr.count, collectionName, criteria)
+    
+    def _nextval(self, seqname, retries=100, block_size=1):
+        return self.submit(self.mgr._nextval, seqname, retries, block_size)
 
 
 class Field(object):  
@@ -159,14 +1540,23 @@ class Field(object):
         self.error = None
      
     # May want to change semantics around this from a question to an imperative or provide both?   
+    # Not thread safe - self.error is shared by every doc of the class.  Use check().
     def is_valid(self, value):
-        self.error = ""
-        # TODO: Do the validation provided by self.validator and put result in self.error
+        self.error = self.check(value)
+        return 0 == len(self.error)
+    
+    def check(self, value):
+        """
+        The error message for value, "" if there is none.  Unlike
+        is_valid this doesn't touch self.error, which is shared by every
+        doc of the class.
+        """
+        error = ""
         if value == None and self.required:
             if self.invalid_message:
-                self.error = self.invalid_message
+                error = self.invalid_message
             else:
-                self.error = '%s is required' % self.name
+                error = '%s is required' % self.name
             
         # TODO: Type check?  Very likely a string value was used to make this object,
         #    we just want to be sure it can be coerced into self.type
@@ -174,9 +1564,9 @@ class Field(object):
         if self.validator:
             s = self.validator(self, value)
             if s:
-                self.error += str(s)
+                error += str(s)
         
-        return 0 == len(self.error)
+        return error
     
 class ListField(Field):
     def __init__(self, type, name, **kwargs):
@@ -184,26 +1574,350 @@ class ListField(Field):
         
 
 class AutoIncField(Field):
-    def __init__(self, name, seqname, **kwargs):
+    def __init__(self, name, seqname, block_size=1, **kwargs):
+        """
+        block_size - sequence values reserved per trip to the server.
+                     See Mgr._nextval.
+        """
         # remove or override "default" in **kwargs
         super(AutoIncField, self).__init__(int, name, **kwargs)
         self.seqname = seqname
+        self.block_size = block_size
         
 class RefField(Field):
     def __init__(self, doctype, name, fld_type, lazy_load, **kwargs):
-        super(RefField, self).__init__(type, name, **kwargs)
+        """
+        doctype   - Doc class the stored _id points at
+        fld_type  - type of the stored _id, e.g. bson.objectid.ObjectId
+        lazy_load - True: the referenced doc is fetched on first attribute
+                    access.  False: Doc.find fetches it for every result
+                    up front, as if it were always in include=[...].
+        
+        doc["name"] is always the _id; doc.name is the referenced doc.
+        """
+        super(RefField, self).__init__(fld_type, name, **kwargs)
         self.doctype = doctype
-        self.type = type
+        self.type = fld_type
         self.lazy_load = lazy_load
         
+class FieldIndex(object):
+    """
+    What the hot paths of a Doc class need to know about its fields,
+    worked out once instead of on every attribute access or query.
+    """
+    def __init__(self, fields):
+        self.fields = fields
+        self.size = len(fields)
+        
+        self.byname = dict((f.name, f) for f in fields)
+        self.names = frozenset(self.byname)
+        
+        self.autoinc = [f for f in fields if isinstance(f, AutoIncField)]
+        self.listofdocs = [f for f in fields if isinstance(f, ListOfDocsField)]
+        self.nested = [f for f in fields if _isdoctype(f.fldtype) and 
+                                            not isinstance(f, ListField)]
+        self.refs = dict((f.name, f) for f in fields if isinstance(f, RefField))
+        self.eager_refs = [f.name for f in fields if isinstance(f, RefField) and 
+                                                     not f.lazy_load]
+        
+        # Fields whose attribute access converts each list item.  A
+        # ListOfDocsField's items are made into docs by hydration.
+        self.lists = dict((f.name, f) for f in fields if isinstance(f, ListField) and 
+                                                        not isinstance(f, ListOfDocsField))
+        
+        # Only fields that can actually fail get checked
+        self.checked = [f for f in fields if f.required or f.validator or 
+                                             isinstance(f, NestedDocField)]
+        
+        self._partials = {}
+        
+    def partial(self, names):
+        """
+        Index of just the named fields, for docs loaded with a projection.
+        """
+        p = self._partials.get(names)
+        if p is None:
+            p = FieldIndex([f for f in self.fields if f.name in names])
+            self._partials[names] = p
+        return p
+        
+    def hydrate(self, o):
+        """
+        Fill in defaults and coerce o's values to their field types, the
+        way Doc.new always has.  The per-field steps are built on first
+        use, and then replace this method on the instance, so a row pays
+        no per-field kind checks.
+        """
+        steps = [_hydrate_step(f) for f in self.fields]
+        def hydrate(o):
+            for step in steps:
+                step(o)
+        self.hydrate = hydrate
+        hydrate(o)
+        
+    def check(self, o):
+        """
+        Field level errors of o as { "field": "message" }.  Like hydrate,
+        the per-field checks are built on first use.
+        """
+        checks = [_check_step(f) for f in self.checked]
+        def check(o):
+            errors = {}
+            for c in checks:
+                c(o, errors)
+            return errors
+        self.check = check
+        return check(o)
+        
+    def stale(self, fields):
+        # fields lists are sometimes appended to after the class is made
+        return fields is not self.fields or len(fields) != self.size
+
+
+def _isdoctype(t):
+    return isinstance(t, type) and issubclass(t, Doc)
+
+
+def _converter(f):
+    # Only called for values that aren't already an f.fldtype
+    t = f.fldtype
+    if isinstance(f, ListOfDocsField):
+        if f.lazy:
+            return lambda v: LazyDocList(t, v)
+        new = t.new
+        return lambda v: [new(item) for item in v]
+    elif isinstance(f, ListField):
+        # fldtype is the type of the items
+        return lambda v: [x if isinstance(x, t) else t(x) for x in v]
+    elif t == int:
+        return lambda v: int(float(v))
+    elif _isdoctype(t):
+        return t.new
+    return t
+
+
+def _hydrate_step(f):
+    name = f.name
+    t = f.fldtype
+    conv = _converter(f)
+    # Loading isn't a change, so skip Doc.__setitem__
+    put = dict.__setitem__
+    
+    if isinstance(f, AutoIncField):
+        # Missing means "not assigned yet" - Doc.save fills it in.
+        def step(o):
+            v = o.get(name, _missing)
+            if v is _missing:
+                put(o, name, None)
+            elif not isinstance(v, t):
+                put(o, name, conv(v))
+    elif f.default:
+        default = f.default
+        def step(o):
+            v = o.get(name, default)
+            if not isinstance(v, t):
+                put(o, name, conv(v))
+            elif v is default:
+                put(o, name, v)
+    else:
+        def step(o):
+            v = o.get(name, _missing)
+            if v is not _missing and not isinstance(v, t):
+                put(o, name, conv(v))
+    
+    if _isdoctype(t):
+        # Nested docs report their changes to o, whether they were made
+        # here or were already docs when they were passed in
+        convert = step
+        def step(o):
+            convert(o)
+            v = o.get(name)
+            if v is not None:
+                _adopt(o, name, v)
+    return step
+
+def _adopt(o, name, v):
+    # Changes inside nested docs mark o[name] as changed
+    if isinstance(v, Doc):
+        v.__dict__["_parent"] = (o, name)
+    elif isinstance(v, LazyDocList):
+        v._own((o, name))
+    elif isinstance(v, list):
+        for x in v:
+            if isinstance(x, Doc):
+                x.__dict__["_parent"] = (o, name)
+
+_missing = object()
+
+
+def _parallel(fn, cls, items, extra, workers):
+    """
+    fn(chunk, *extra) for each PARALLEL_CHUNK of items, run in a pool of
+    workers processes.  Yields what each call returns, flattened, in
+    order.
+    """
+    try:
+        pickle.dumps(cls, 2)
+    except (pickle.PicklingError, TypeError, AttributeError), e:
+        raise OCMNotAllowedException("%s can't be sent to worker processes "
+                                     "- define it at module level (%s)" % (cls.__name__, e))
+    
+    def chunks():
+        chunk = []
+        for i in items:
+            chunk.append(i)
+            if len(chunk) == PARALLEL_CHUNK:
+                yield (fn, chunk, extra)
+                chunk = []
+        if chunk:
+            yield (fn, chunk, extra)
+    
+    pool = multiprocessing.Pool(workers)
+    try:
+        for done in pool.imap(_call, chunks()):
+            for x in done:
+                yield x
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _call(job):
+    # Runs in the worker process
+    fn, chunk, extra = job
+    return fn(chunk, *extra)
+
+def _hydrate_chunk(rows, cls, projection):
+    return [cls.new(r, loaded=projection)._clean() for r in rows]
+
+def _validate_chunk(docs):
+    out = []
+    for d in docs:
+        d._validate()
+        out.append(d._errors)
+    return out
+
+
+def _niceval(conv, v):
+    # A criteria value, or the operands of {"$in": [...]}, {"$gt": x}...
+    # None stays None - it matches missing and null fields.
+    if v is None:
+        return v
+    if not isinstance(v, dict):
+        return conv(v)
+    ret = {}
+    for op, x in v.iteritems():
+        if op in ("$in", "$nin", "$all"):
+            ret[op] = [i if i is None else conv(i) for i in x]
+        elif op in ("$ne", "$gt", "$gte", "$lt", "$lte"):
+            ret[op] = x if x is None else conv(x)
+        else:
+            ret[op] = x
+    return ret
+
+def _token(key, direction, last, lastid):
+    # Opaque to callers; BSON keeps ObjectIds and datetimes intact
+    data = BSON.encode({"k": key, "d": direction, "v": last, "i": lastid})
+    return base64.urlsafe_b64encode(data)
+
+def _untoken(token):
+    try:
+        data = BSON(base64.urlsafe_b64decode(str(token))).decode()
+        return data["k"], data["d"], data["v"], data["i"]
+    except Exception:
+        raise OCMInvalidException("bad page token")
+
+# Update operators whose operands are values of the field
+_VALUE_OPS = frozenset(["$set", "$setOnInsert", "$inc", "$mul", "$min", "$max",
+                        "$push", "$addToSet", "$pushAll"])
+
+def _coerce(f, v):
+    if v is None or isinstance(v, f.fldtype):
+        return v
+    return _converter(f)(v)
+
+def _coerceitem(f, v):
+    # Only a ListField's fldtype is the type of its items
+    if isinstance(f, ListField) and not isinstance(f, ListOfDocsField):
+        if not isinstance(v, f.fldtype):
+            return f.fldtype(v)
+    return v
+
+def _coerceitems(f, v):
+    if isinstance(v, dict) and v.has_key("$each"):
+        v = dict(v)
+        v["$each"] = [_coerceitem(f, x) for x in v["$each"]]
+        return v
+    return _coerceitem(f, v)
+
+
+def _check_step(f):
+    name = f.name
+    if isinstance(f, NestedDocField):
+        check = f.check
+        def step(o, errors):
+            v = o.get(name)
+            if isinstance(v, Doc):
+                if not v.is_valid():
+                    errors[name] = v.errors()
+            else:
+                e = check(v)
+                if e:
+                    errors[name] = e
+    else:
+        check = f.check
+        def step(o, errors):
+            e = check(o.get(name))
+            if e:
+                errors[name] = e
+    return step
+
+
+class ClassOrInstanceMethod(object):
+    """
+    One method when looked up on the class, another on an instance.
+    Lets Doc.update(criteria, changes) update on the server while
+    doc.update(other) stays dict.update.
+    """
+    def __init__(self, clsfunc, instfunc):
+        self.clsfunc = clsfunc
+        self.instfunc = instfunc
+        
+    def __get__(self, obj, cls):
+        if obj is None:
+            return types.MethodType(self.clsfunc, cls)
+        return types.MethodType(self.instfunc, obj)
+
+
+class DocMeta(type):
+    def __init__(cls, name, bases, attrs):
+        super(DocMeta, cls).__init__(name, bases, attrs)
+        cls._index = None
+        if cls.fields:
+            cls._fieldindex()
+
+
 class Doc(dict):
+    __metaclass__ = DocMeta
       
     mgr = None     
     collection = ""
     fields = []
     
-    # Start with a simple { "field": "message" }
-    _errors = {}
+    # Set to a QueryCache to cache find() and count() results
+    cache = None
+    
+    # Indexes find() etc rely on, see Index and Mgr.ensure_indexes
+    indexes = []
+    
+    # Start with a simple { "field": "message" }, one per doc
+    @property
+    def _errors(self):
+        return self.__dict__.setdefault("_errors", {})
+    
+    @_errors.setter
+    def _errors(self, errors):
+        self.__dict__["_errors"] = errors
 
     def errors(self):
         return self._errors
@@ -212,35 +1926,67 @@ class Doc(dict):
 
     # Master validation routine
     def _validate(self):
-        self._errors = {}
-        
         # Make sure we have a valid Mgr
 #    This can cause problems with NestedDocField types
 #        if not isinstance(self.mgr, Mgr):
 #            self._errors["mgr"] = "Not a valid Mgr"
             
         # run through the fields list calling individual validators
-        for f in self.fields:
-            if isinstance(f, NestedDocField):
-                if not self.get(f.name).is_valid():
-                    self._errors[f.name] = f.error
+        idx = self._fieldindex()
+        loaded = self.__dict__.get("_loaded")
+        if loaded is not None:
+            idx = idx.partial(loaded)
+        
+        prof = None
+        if _profiling:
+            prof = _profiler(self.mgr)
+        if prof is None:
+            errors = idx.check(self)
+            self.__dict__["_errors"] = errors
             
-            elif not f.is_valid(self.get(f.name, None)):
-                self._errors[f.name] = f.error
-             
-        # call any app specific validation if needed
-        errs = self.validate(self)
+            # call any app specific validation if needed
+            errs = self.validate(self)
+        else:
+            name = type(self).__name__
+            errors = _timed(prof, "validate", name, idx.check, self)
+            self.__dict__["_errors"] = errors
+            errs = _timed(prof, "hooks", name, self.validate, self)
         if errs:
             if isinstance(errs, list):
                 for k, v in errs:
-                    self._errors[k] = v
+                    errors[k] = v
             else:
-                self._errors[errs[0]] = errs[1]
+                errors[errs[0]] = errs[1]
     
     def is_valid(self):
         self._validate()
         return 0 == len(self._errors)
     
+    @classmethod
+    def validate_many(cls, docs, workers=None):
+        """
+        Validate a batch of docs in one go, e.g. ahead of save_all.  Each
+        doc's errors() is brought up to date as well.
+        
+        Returns {"checked": n, "invalid": k, "errors": {i: errors}} with
+        only the invalid docs, by position, in "errors".
+        
+        workers - validate in this many processes, see Mgr._hydrate.
+                  validate() overrides run there too, so changes they
+                  make to the doc are lost.
+        """
+        if workers > 1:
+            found = _parallel(_validate_chunk, cls, docs, (), workers)
+        else:
+            found = _validate_chunk(docs)
+        
+        report = {}
+        for i, errors in enumerate(found):
+            docs[i].__dict__["_errors"] = errors
+            if errors:
+                report[i] = errors
+        return {"checked": len(docs), "invalid": len(report), "errors": report}
+    
     
     # These can be overridden by subclasses to get app specific behavior
     def validate(self, item):
@@ -269,29 +2015,33 @@ class Doc(dict):
         2. Do any app defined pre-save stuff
         3. Actually save
         4. Do any app defined post-save stuff
+        
+        Partial docs (loaded with a projection) raise
+        OCMNotAllowedException rather than overwrite the stored document
+        with only some of its fields.
         """
+        self._check_whole()
         
         self._validate()
         if 0 != len(self._errors):
             raise OCMInvalidException
         
-        for f in self.fields:
-            if isinstance(f, AutoIncField):
-                if not self.has_key(f.name):
-                    self[f.name] = self.mgr._nextval(f.seqname)
-                    break
+        for f in self._fieldindex().autoinc:
+            if not self.has_key(f.name):
+                self[f.name] = self.mgr._nextval(f.seqname, block_size=f.block_size)
+                break
         
 #         TODO: Figure out a way for before_save to 
         #        send a message back through the call stack
         #        via _errors?
-        if self.before_save and not self.before_save(self):
+        prof = None
+        if _profiling:
+            prof = _profiler(self.mgr)
+        if self.before_save and not _timed(prof, "hooks", type(self).__name__, 
+                                           self.before_save, self):
             return False
         
-        for f in self.fields:
-            if isinstance(f, AutoIncField):
-                if not self.has_key(f.name) or not self.get(f.name):
-                    self[f.name] = self.mgr._nextval(f.seqname)
-                    continue
+        self._assign_seqs()
         
         # would be good to pass the result of 
         # _mgr.save() to after_save!
@@ -300,32 +2050,267 @@ class Doc(dict):
             return False
         
         if self.after_save:
-            self.after_save(self)
+            _timed(prof, "hooks", type(self).__name__, self.after_save, self)
             
         return 0 == len(self._errors)
 #                o["_id"] = pymongo.objectid.ObjectId(o["_id"])
+
+    def _check_whole(self):
+        if self.__dict__.get("_loaded") is not None:
+            raise OCMNotAllowedException(PARTIAL_DOC)
+    
+    def reload(self):
+        """
+        Fetch the rest of a partial doc.  Fields that were loaded keep
+        their current values, so changes made to them are kept.
+        """
+        rows = list(self.mgr._find(self.collection, {"_id": self["_id"]}))
+        if not rows:
+            raise OCMInvalidException("%s is no longer stored" % self["_id"])
+        
+        row = rows[0]
+        for k in self.__dict__.get("_loaded", ()):
+            if self.has_key(k):
+                row[k] = self[k]
+        
+        whole = self.new(row)
+        self.__dict__.pop("_loaded", None)
+        dict.clear(self)
+        dict.update(self, whole)
+        for k, v in self.iteritems():
+            _adopt(self, k, v)
+        self._validate()
+        return self
+    
+    def _assign_seqs(self):
+        for f in self._unassigned_seqs():
+            self[f.name] = self.mgr._nextval(f.seqname, block_size=f.block_size)
+    
+    def _unassigned_seqs(self):
+        return [f for f in self._fieldindex().autoinc
+                if not self.has_key(f.name) or not self.get(f.name)]
+    
+    @classmethod
+    def _assign_seqs_many(cls, docs):
+        # One findAndModify per sequence for the whole batch, rather than
+        # one per doc.  Values go out in doc order.
+        wanted = OrderedDict()
+        for d in docs:
+            for f in d._unassigned_seqs():
+                wanted.setdefault(f.seqname, []).append((d, f))
+        
+        for seqname, slots in wanted.iteritems():
+            if len(slots) == 1:
+                d, f = slots[0]
+                d[f.name] = cls.mgr._nextval(seqname, block_size=f.block_size)
+                continue
+            
+            last = cls.mgr._reserve(seqname, len(slots))
+            for v, (d, f) in enumerate(slots, last - len(slots) + 1):
+                d[f.name] = v
+    
+    @classmethod
+    def save_all(cls, docs, batch_size=1000, ordered=True):
+        """
+        Bulk save().  Each doc is validated, given its AutoIncField values
+        and passed through before_save; the ones that make it are written
+        with Mgr.save_many and then passed to after_save.
+        
+        Bad docs don't raise.  Returns one (ok, errors) tuple per doc,
+        errors being what doc.errors() would give.  ordered only affects
+        the writes - every doc is validated regardless.
+        """
+        prof = None
+        if _profiling:
+            prof = _profiler(cls.mgr)
+        
+        results = [None] * len(docs)
+        valid = []
+        for i, d in enumerate(docs):
+            if d.__dict__.get("_loaded") is not None:
+                results[i] = (False, {"save": PARTIAL_DOC})
+                continue
+            
+            d._validate()
+            if 0 != len(d._errors):
+                results[i] = (False, d._errors)
+                continue
+            valid.append(i)
+        
+        cls._assign_seqs_many([docs[i] for i in valid])
+        
+        ready = []
+        for i in valid:
+            d = docs[i]
+            if d.before_save and not _timed(prof, "hooks", cls.__name__, d.before_save, d):
+                results[i] = (False, {"before_save": "before_save returned False"})
+                continue
+            ready.append(i)
+        
+        written = cls.mgr.save_many([docs[i] for i in ready],
+                                    batch_size=batch_size, ordered=ordered)
+        for i, err in zip(ready, written):
+            d = docs[i]
+            if err:
+                d._errors = {"save": err}
+                results[i] = (False, d._errors)
+                continue
+            
+            if d.after_save:
+                _timed(prof, "hooks", cls.__name__, d.after_save, d)
+            results[i] = (True, d._errors)
+            
+        return results
     def delete(self):
         return self.mgr.delete(self)
         
     @classmethod
     def remove(cls, criteria=None, confirmNoCriteria=None):
-        print "remove ", criteria
+        """
+        Remove all docs matching criteria, see Mgr.remove.
+        """
+        crit = {}
+        if criteria:
+            crit = cls._makeNiceSpec(cls, criteria)
+            
+        return cls.mgr.remove(cls, crit, confirmNoCriteria=confirmNoCriteria)
+    
+    @classmethod
+    def delete_ids(cls, ids):
+        # Coerced like any other _id criteria, so string ids match
+        ids = cls._makeNiceSpec(cls, {"_id": {"$in": list(ids)}})["_id"]["$in"]
+        return cls.mgr.delete_ids(cls, ids)
+    
+    @classmethod
+    def _has_del_hooks(cls):
+        return (cls.before_del.im_func is not Doc.before_del.im_func or
+                cls.after_del.im_func is not Doc.after_del.im_func)
+        
+    @classmethod
+    def find(cls, criteria=None, include=None, projection=None, sort=None, limit=None,
+             skip=None, hint=None, max_time_ms=None, workers=None):
+        """
+        include    - names of RefFields to fetch for all results at once,
+                     e.g. Order.find(crit, include=["customer"])
+        projection - names of the only fields to fetch, e.g. for a
+                     listing.  Gives partial docs - see new().
+        
+        sort, limit, skip, hint and max_time_ms are passed to the server,
+        see Mgr.get:
+            Order.find({"status": "open"}, sort=[("created", -1)], limit=20)
+        
+        workers    - hydrate in that many processes, see Mgr._hydrate
+        """
+        crit = {}
+        if criteria:
+            crit = cls._makeNiceSpec(cls, criteria)
+        
+        if cls.cache is not None:
+            rows = cls.cache.find(cls, crit, projection, sort=sort, limit=limit, 
+                                  skip=skip, hint=hint, max_time_ms=max_time_ms)
+            docs = list(cls.mgr._hydrate(cls, rows, projection, workers))
+        else:
+            docs = cls.mgr.get(cls, crit, projection=projection, sort=sort, limit=limit,
+                               skip=skip, hint=hint, max_time_ms=max_time_ms,
+                               workers=workers)
+        
+        names = cls._fieldindex().eager_refs
+        if include:
+            names = names + [n for n in include if n not in names]
+        if names:
+            cls._include(docs, names)
+        return docs
+    
+    @classmethod
+    def first(cls, criteria=None, sort=None, projection=None):
+        """
+        The first doc find() would give in sort order, or None.
+        """
+        docs = cls.find(criteria, projection=projection, sort=sort, limit=1)
+        if docs:
+            return docs[0]
+        return None
+    
+    @classmethod
+    def page(cls, criteria=None, sort_key="_id", direction=1, limit=50, token=None):
+        """
+        One page of find(criteria) in sort_key order, and the token for
+        the next page (None after the last one):
+        
+            docs, token = Order.page({"status": "open"}, "created")
+            while token:
+                docs, token = Order.page({"status": "open"}, "created", token=token)
+                
+        Each page is a query for the rows past the last one seen, ties
+        broken on _id, so page 1000 costs the same as page 1 given an
+        index on (sort_key, _id).  Docs without sort_key come first, as
+        the server sorts them.
+        """
+        crit = {}
+        if criteria:
+            crit = cls._makeNiceSpec(cls, criteria)
+        
+        if token:
+            key, d, last, lastid = _untoken(token)
+            if key != sort_key or d != direction:
+                raise OCMInvalidException("token is for a different sort")
+            
+            op = direction > 0 and "$gt" or "$lt"
+            if sort_key == "_id":
+                past = {"_id": {op: lastid}}
+            else:
+                # Missing and null sort before every value, and $gt/$lt
+                # never match them, so they get their own clauses
+                ties = {sort_key: last, "_id": {op: lastid}}
+                if last is None and direction > 0:
+                    past = {"$or": [{sort_key: {"$ne": None}}, ties]}
+                elif last is None:
+                    past = ties
+                elif direction > 0:
+                    past = {"$or": [{sort_key: {op: last}}, ties]}
+                else:
+                    past = {"$or": [{sort_key: {op: last}}, ties, {sort_key: None}]}
+            if crit:
+                crit = {"$and": [crit, past]}
+            else:
+                crit = past
+        
+        sort = [(sort_key, direction)]
+        if sort_key != "_id":
+            sort.append(("_id", direction))
+            
+        # One extra row says whether there is a next page
+        rows = list(cls.mgr._find(cls.collection, crit, sort=sort, limit=limit + 1))
+        more = len(rows) > limit
+        docs = list(cls.mgr._hydrate(cls, rows[:limit]))
         
+        token = None
+        if more:
+            last = docs[-1]
+            token = _token(sort_key, direction, last.get(sort_key), last["_id"])
+        return docs, token
+    
     @classmethod
-    def find(cls, criteria=None):
+    def iter_find(cls, criteria=None, batch_size=None, sort=None, limit=None, skip=None,
+                  hint=None, max_time_ms=None, workers=None):
+        """
+        find() as a generator - see Mgr.iter_get.
+        """
         crit = {}
         if criteria:
             crit = cls._makeNiceSpec(cls, criteria)
         
-        return cls.mgr.get(cls, crit)
+        return cls.mgr.iter_get(cls, crit, batch_size=batch_size, sort=sort, limit=limit,
+                                skip=skip, hint=hint, max_time_ms=max_time_ms,
+                                workers=workers)
     
     @classmethod
-    def retrieve(cls, criteria=None):
+    def retrieve(cls, criteria=None, projection=None):
         crit = {}
         if criteria:
             crit = cls._makeNiceSpec(cls, criteria)
             
-        return cls.mgr.retrieve(cls, crit)
+        return cls.mgr.retrieve(cls, crit, projection=projection)
         
     @staticmethod
     def _makeNiceSpec(obj, spec):
@@ -336,24 +2321,88 @@ class Doc(dict):
         
         ret.update(spec)
         
-        d = dict((f.name, f) for f in obj.fields)
+        d = obj._fieldindex().byname
         for k, v in ret.iteritems():
             if k == "_id":
-                ret["_id"] = pymongo.objectid.ObjectId(v)
+                ret["_id"] = _niceval(ObjectId, v)
             elif d.has_key(k):
 #                for f in obj.fields:
 #                    if k == f.name:
-                ret[k] = d[k].fldtype(v)
+                ret[k] = _niceval(d[k].fldtype, v)
         
         return ret
         
+    def _server_update(cls, criteria, changes, multi=False, upsert=False):
+        """
+        Server side update, e.g.
+            Counter.update({"name": "hits"}, {"$inc": {"value": 1}})
+        See Mgr.update.  On an instance, update is still dict.update.
+        """
+        crit = {}
+        if criteria:
+            crit = cls._makeNiceSpec(cls, criteria)
+        
+        return cls.mgr.update(cls, crit, changes, multi=multi, upsert=upsert)
+    
+    @classmethod
+    def _makeNiceChanges(cls, changes):
+        """
+        Coerce the values in an update document to the field types, the
+        way _makeNiceSpec does for criteria.  Values pushed onto a
+        ListField are coerced to its item type.  Only operators that take
+        field values are touched - $pop, $bit, $currentDate, $pull and
+        the rest, and dotted paths, are left as they are.
+        """
+        d = cls._fieldindex().byname
+        ret = {}
+        for op, fields in changes.iteritems():
+            if op not in _VALUE_OPS or not isinstance(fields, dict):
+                ret[op] = fields
+                continue
+            
+            vals = {}
+            for k, v in fields.iteritems():
+                f = d.get(k)
+                if f is None:
+                    vals[k] = v
+                elif op in ("$push", "$addToSet"):
+                    vals[k] = _coerceitems(f, v)
+                elif op == "$pushAll":
+                    vals[k] = [_coerceitem(f, x) for x in v]
+                else:
+                    vals[k] = _coerce(f, v)
+            ret[op] = vals
+        return ret
+    
     @classmethod
     def count(cls, criteria=None):
         crit = {}
         if criteria:
             crit = cls._makeNiceSpec(cls, criteria)
             
+        if cls.cache is not None:
+            return cls.cache.count(cls, crit)
         return cls.mgr.count(cls.collection, crit)
+    
+    # Future-returning versions of the above, run on the Mgr's AsyncMgr
+    def save_async(self):
+        return self.mgr.asyncmgr().submit(self.save)
+    
+    @classmethod
+    def find_async(cls, criteria=None, **kw):
+        return cls.mgr.asyncmgr().submit(cls.find, criteria, **kw)
+    
+    @classmethod
+    def first_async(cls, criteria=None, **kw):
+        return cls.mgr.asyncmgr().submit(cls.first, criteria, **kw)
+    
+    @classmethod
+    def retrieve_async(cls, criteria=None, projection=None):
+        return cls.mgr.asyncmgr().submit(cls.retrieve, criteria, projection)
+    
+    @classmethod
+    def count_async(cls, criteria=None):
+        return cls.mgr.asyncmgr().submit(cls.count, criteria)
 
     @classmethod
     def diag(cls):
@@ -364,55 +2413,44 @@ class Doc(dict):
         print cls.collection
 
     @classmethod
-    def new(cls, data=None):
-        o = cls()
-        if 0 == len(o.fields):
+    def _fieldindex(cls):
+        idx = cls._index
+        if idx is None or idx.stale(cls.fields):
+            idx = cls._index = FieldIndex(cls.fields)
+        return idx
+
+    @classmethod
+    def new(cls, data=None, loaded=None):
+        """
+        loaded - when data was fetched with a projection, the field names
+                 it was limited to.  Only those fields get defaults,
+                 conversion and validation, and save() refuses the doc
+                 until reload() has fetched the rest.
+        """
+        idx = cls._fieldindex()
+        if 0 == idx.size:
             raise OCMInvalidException
         
         # Everything in data goes into object.  Validate after.
+        # TODO: Be sure there's no Field name _id!
         if data and isinstance(data, dict):
-            o.update(data)
-            # TODO: Be sure there's no Field name _id!
-#            if o.has_key("_id"):
-                
-#            if o.has_key("status"):
-#                pass
-#                print o["_id"]
-
-
-#                o["_id"] = pymongo.objectid.ObjectId(o["_id"])
+            o = cls(data)
+        else:
+            o = cls()
+            
+        if loaded is not None:
+            loaded = frozenset(loaded)
+            o.__dict__["_loaded"] = loaded
+            idx = idx.partial(loaded)
 
         # 1. Be sure any fields that have a default value specified,
         #    but aren't in the incoming data get set with default
         # 2. Convert values to types specfied in fields list
         # 3. Validate!
-        for f in o.fields:
-            if isinstance(f, AutoIncField):
-                if not o.has_key(f.name):
-                    o[f.name] = None
-                    continue
-
-            if f.default and not o.has_key(f.name):
-                o[f.name] = f.default
-
-            if o.has_key(f.name):
-                if isinstance(o[f.name], f.fldtype):
-                    pass # do nothing -it's ok
-                elif f.fldtype == int:
-                    o[f.name] = int(float(o[f.name]))
-                elif isinstance(f, ListOfDocsField):
-#                    for x in range(len(o[f.name])):
-#                        o[f.name][x] = f.fldtype(o[f.name][x])
-                    # TODO: list comprehension!
-                    l = []
-                    for item in o[f.name]:  #.iteritems():
-                        l.append(f.fldtype.new(item))
-                    o[f.name] = l
-                elif Doc in f.fldtype.__bases__:
-                    o[f.name] = f.fldtype.new(o[f.name])
-                else:
-                    o[f.name] = f.fldtype(o[f.name])
-
+        if _profiling:
+            _timed(_profiler(cls.mgr), "hydrate", cls.__name__, idx.hydrate, o)
+        else:
+            idx.hydrate(o)
             
         o.is_valid()
         return o          
@@ -430,39 +2468,171 @@ class Doc(dict):
 #                if Doc in d[name].__bases__:
 #                    return d[name].new(self[name])
                 
-            d = dict((f.name, f) for f in self.fields)
-            if d.has_key(name):
-#                if ListField in d[name].__bases__:
-#                    return list( (d[name].fldtype(x)) for x in self[name]  )
-#                if Doc in d[name].fldtype.__bases__:
-                
-#                if isinstance(d[name], RefField):
-#                    return d[name].doctype.retrieve({"_id": self[name]})
-                
-                if isinstance(d[name], Doc):
-                    return d[name].fldtype.new(self[name])
-                elif isinstance(d[name], ListField):
-                    return list( (d[name].fldtype(x)) for x in self[name]  )
+            idx = self._fieldindex()
+            if idx.refs.has_key(name):
+                return self._deref(idx.refs[name])
+            
+            lists = idx.lists
+            if lists.has_key(name):
+                return list( (lists[name].fldtype(x)) for x in self[name]  )
                 
             return self[name]
         except KeyError:
             raise AttributeError, name
         
+    def _deref(self, f):
+        _id = self.get(f.name)
+        if _id is None:
+            return None
+        
+        ref = self.__dict__.get("_refs", {}).get(f.name)
+        if ref is None or ref[0] != _id:
+            found = f.doctype.mgr.get(f.doctype, {"_id": _id})
+            ref = self._setref(f.name, _id, found and found[0] or None)
+        return ref[1]
+    
+    def _setref(self, name, _id, doc):
+        ref = (_id, doc)
+        self.__dict__.setdefault("_refs", {})[name] = ref
+        return ref
+    
+    @classmethod
+    def _include(cls, docs, names):
+        # One $in query per referenced field, instead of one per doc
+        refs = cls._fieldindex().refs
+        for name in names:
+            if not refs.has_key(name):
+                raise OCMInvalidException("%s is not a RefField" % name)
+            f = refs[name]
+            
+            ids = set(d.get(name) for d in docs if d.get(name) is not None)
+            if not ids:
+                continue
+            found = dict((r["_id"], r) for r in 
+                         f.doctype.mgr.get(f.doctype, {"_id": {"$in": list(ids)}}))
+            for d in docs:
+                if d.get(name) is not None:
+                    d._setref(name, d[name], found.get(d[name]))
+        return docs
+        
+    # Change tracking.  Keys set or deleted since the doc was loaded or
+    # saved are in _dirty; nested docs and LazyDocLists report changes
+    # to the key they live under.  Plain lists and dicts changed in
+    # place aren't seen - assign them again, or touch() the field.
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if isinstance(value, (Doc, LazyDocList)):
+            _adopt(self, key, value)
+        self._mark(key)
+        
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._mark(key)
+        
+    def _dict_update(self, *l, **kw):
+        for k, v in dict(*l, **kw).iteritems():
+            self[k] = v
+    
+    update = ClassOrInstanceMethod(_server_update, _dict_update)
+            
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+    
+    def pop(self, key, *default):
+        if key in self:
+            self._mark(key)
+        return dict.pop(self, key, *default)
+    
+    def popitem(self):
+        k, v = dict.popitem(self)
+        self._mark(k)
+        return k, v
+    
+    def clear(self):
+        for k in self.keys():
+            self._mark(k)
+        dict.clear(self)
+    
+    def touch(self, name):
+        """
+        Count name as changed, e.g. after appending to a plain list.
+        """
+        self._mark(name)
+    
+    def _mark(self, key):
+        d = self.__dict__
+        dirty = d.get("_dirty")
+        if dirty is None:
+            dirty = d["_dirty"] = set()
+        dirty.add(key)
+        parent = d.get("_parent")
+        if parent is not None:
+            parent[0]._mark(parent[1])
+            
+    def _clean(self):
+        # Now matches what is stored
+        self.__dict__["_dirty"] = set()
+        self.__dict__["_persisted"] = True
+        return self
+    
+    def _changes(self):
+        """
+        The update that brings the stored copy up to date, {} if there
+        is nothing to do, None if the doc has to be written whole (never
+        stored, or its _id changed).
+        """
+        d = self.__dict__
+        if not d.get("_persisted") or not self.has_key("_id"):
+            return None
+        dirty = d.get("_dirty")
+        if not dirty:
+            return {}
+        if "_id" in dirty:
+            return None
+        
+        sets = {}
+        unsets = {}
+        for k in dirty:
+            if self.has_key(k):
+                sets[k] = self[k]
+            else:
+                unsets[k] = 1
+        changes = {}
+        if sets:
+            changes["$set"] = sets
+        if unsets:
+            changes["$unset"] = unsets
+        return changes
+        
+    def __reduce__(self):
+        # Pickle (e.g. to and from worker processes) without going back
+        # through __setitem__, which would mark every field changed.
+        return (_newdoc, (type(self),), (dict(self), self.__dict__))
+    
+    def __setstate__(self, state):
+        items, attrs = state
+        dict.update(self, items)
+        self.__dict__.update(attrs)
+        
     def __setattr__(self, name, value):
         # This works nicely for saying fields []  is complete!
-        # isn't there a more pythonic way of expressing this?
-#        s = False
-#        for field in self.fields:
-#            if name == field.name:
-#                s = True
-#                break
-        
-        if (name in list((f.name) for f in self.fields)):
+        idx = self._fieldindex()
+        if name in idx.names:
+            if isinstance(value, Doc) and idx.refs.has_key(name):
+                # Store the reference, remember what it points at
+                self._setref(name, value.get("_id"), value)
+                value = value.get("_id")
             self.__setitem__(name, value)
         else:
             super(Doc, self).__setattr__(name, value)
 
 
+def _newdoc(cls):
+    return dict.__new__(cls)
+
+
 class NestedDocField(Field):
     def is_valid(self):
         self._errors = {}
@@ -470,8 +2640,9 @@ class NestedDocField(Field):
             
         # run through the fields list calling individual validators
         for f in self.fields:
-            if not f.is_valid(self.get(f.name, None)):
-                self._errors[f.name] = f.error
+            e = f.check(self.get(f.name, None))
+            if e:
+                self._errors[f.name] = e
              
         # call any app specific validation if needed
         errs = self.validate(self)
@@ -485,9 +2656,137 @@ class NestedDocField(Field):
         return 0 == len(self._errors)   
     
 class ListOfDocsField(ListField):
-    def __init__(self, type, name, **kwargs):
+    def __init__(self, type, name, lazy=True, **kwargs):
+        """
+        lazy - keep items as the raw dicts they were loaded as until they
+               are read.  See LazyDocList.
+        """
         # remove or override "default" in **kwargs
         super(ListOfDocsField, self).__init__(type, name, **kwargs)
+        self.lazy = lazy
+        
+
+class LazyDocList(list):
+    """
+    The list a lazy ListOfDocsField holds.  Items stay the raw dicts they
+    came from the server as, and each one is made into a doctype (so
+    hydrated and validated by new()) the first time it is read.  Raw and
+    hydrated items are both dicts, so the list saves the same either way.
+    """
+    def __init__(self, doctype, items=()):
+        list.__init__(self, items)
+        self.doctype = doctype
+        self.owner = None       # (doc, field name) this list is in
+    
+    def _own(self, owner):
+        self.owner = owner
+        self._take(list.__iter__(self))
+    
+    def _take(self, items):
+        # Docs put in the list as they are report their changes to its
+        # owner, like the ones _load makes
+        if self.owner:
+            for item in items:
+                if isinstance(item, self.doctype):
+                    item.__dict__["_parent"] = self.owner
+        
+    def _load(self, i):
+        item = list.__getitem__(self, i)
+        if not isinstance(item, self.doctype):
+            item = self.doctype.new(item)
+            if self.owner:
+                item.__dict__["_parent"] = self.owner
+            list.__setitem__(self, i, item)
+        return item
+    
+    def _changed(self):
+        if self.owner:
+            self.owner[0]._mark(self.owner[1])
+    
+    def __reduce__(self):
+        # Like Doc's - the raw items as they are, and not counted as a change
+        return (LazyDocList, (self.doctype,), (list(list.__iter__(self)), self.owner))
+    
+    def __setstate__(self, state):
+        items, self.owner = state
+        list.extend(self, items)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._load(x) for x in range(*i.indices(len(self)))]
+        return self._load(i)
+    
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+    
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._load(i)
+            
+    def __reversed__(self):
+        for i in xrange(len(self) - 1, -1, -1):
+            yield self._load(i)
+            
+    def pop(self, i=-1):
+        item = self._load(i)
+        list.pop(self, i)
+        self._changed()
+        return item
+    
+    def __setitem__(self, i, v):
+        if isinstance(i, slice):
+            v = list(v)
+            self._take(v)
+        else:
+            self._take((v,))
+        list.__setitem__(self, i, v)
+        self._changed()
+        
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self._changed()
+        
+    def __setslice__(self, i, j, v):
+        v = list(v)
+        self._take(v)
+        list.__setslice__(self, i, j, v)
+        self._changed()
+    
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._changed()
+        
+    def __iadd__(self, v):
+        self.extend(v)
+        return self
+    
+    def append(self, v):
+        list.append(self, v)
+        self._take((v,))
+        self._changed()
+    
+    def extend(self, v):
+        v = list(v)
+        self._take(v)
+        list.extend(self, v)
+        self._changed()
+        
+    def insert(self, i, v):
+        list.insert(self, i, v)
+        self._take((v,))
+        self._changed()
+    
+    def remove(self, v):
+        list.remove(self, v)
+        self._changed()
+        
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+        
+    def sort(self, *l, **kw):
+        list.sort(self, *l, **kw)
+        self._changed()
         
 
 #if __name__ == "__main__":
@@ -1,11 +1,26 @@
 import unittest
+import bson.objectid
 import pymongo
 from pymongo import Connection
 
 from ocm import *
 
+import pickle
 import time
 
+# Parallel hydration finds Doc classes by module path, so these can't
+# live inside the tests.
+class PItem(Doc):
+    fields = [Field(str, "sku"),
+              Field(int, "qty")]
+
+class POrder(Doc):
+    mgr = Mgr("localhost", 27017, "test")
+    collection = "test"
+    fields = [Field(str, "fld1", required=True),
+              Field(int, "num"),
+              ListOfDocsField(PItem, "items")]
+
 class TestDoc(unittest.TestCase):
     dat = {"fld1": "field-one", "fld2": "field-two"}
 
@@ -491,35 +506,313 @@ class TestDoc(unittest.TestCase):
         self.assertTrue(isinstance(m.nuggets, dict))
         self.assertTrue(len(m.nuggets) > 1)
         
-#    def test_RefField(self):
-#        class O(Doc):
-#            mgr = Mgr("localhost", 27017, "test")
-#            collection = "other"
-#            fields = [Field(str, "greeting")
-#                      ]
-#            
-#        class N(Doc):
-#            mgr = Mgr("localhost", 27017, "test")
-#            collection = "test"
-##            fields = [RefField(O, "ref_id", pymongo.objectid.ObjectId, False)
-#            fields = [RefField(O, "ref_id", str, False)
-#                      ]
-#      
-#        reffedobj = O.new({"greeting": "howdy there"})
-#        self.assertEqual(reffedobj.save(), True)
-#        
-#        n = N.new({"ref_id": reffedobj._id})
-#        self.assertEqual(n.save(), True)
-#        
-#        print n
-#        print n.ref_id
-        
-      
-      
-      
+    def test_RefField(self):
+        class O(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "other"
+            fields = [Field(str, "greeting")
+                      ]
             
+        class N(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [RefField(O, "ref_id", bson.objectid.ObjectId, True)
+                      ]
       
-      
+        reffedobj = O.new({"greeting": "howdy there"})
+        self.assertEqual(reffedobj.save(), True)
+        
+        n = N.new({"ref_id": reffedobj._id})
+        self.assertEqual(n.save(), True)
+        
+        self.assertEqual(n["ref_id"], reffedobj._id)
+        self.assertEqual(n.ref_id.greeting, "howdy there")
+        self.assertTrue(n.ref_id is n.ref_id)
+        
+        # Assigning a doc stores its _id
+        n.ref_id = reffedobj
+        self.assertEqual(n["ref_id"], reffedobj._id)
+        self.assertTrue(n.ref_id is reffedobj)
+        
+        # include= fills in every result's reference up front
+        N.new({"ref_id": reffedobj._id}).save()
+        found = N.find({"ref_id": reffedobj._id}, include=["ref_id"])
+        self.assertEqual(2, len(found))
+        for x in found:
+            self.assertEqual(x.__dict__["_refs"]["ref_id"][1].greeting, "howdy there")
+        
+        self.assertRaises(OCMInvalidException, N.find, None, ["nope"])
+        
+        db = Connection('localhost', 27017).test
+        db.other.remove()
+        db.test.remove({"ref_id": reffedobj._id})
+
+    def test_saveAll(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1", required=True),
+                      Field(str, "fld2"),
+                      AutoIncField("fld_id", "testseq_all")]
+            
+            def after_save(self, item):
+                item.saved = True
+        
+        docs = [M.new(self.dat), M.new({"fld2": "no fld1"}), M.new(self.dat)]
+        before = M.count()
+        
+        res = M.save_all(docs, batch_size=2)
+        
+        self.assertEqual(res[0], (True, {}))
+        self.assertEqual(res[1][0], False)
+        self.assertEqual(res[1][1]["fld1"], "fld1 is required")
+        self.assertEqual(res[2], (True, {}))
+        self.assertEqual(before + 2, M.count())
+        
+        self.assertTrue(docs[0]._id)
+        self.assertTrue(docs[0].saved)
+        self.assertEqual(docs[0].fld_id + 1, docs[2].fld_id)
+        self.assertFalse(docs[1].has_key("_id"))
+
+        # One trip to the sequence for the whole batch
+        class Trips(Listener):
+            ops = []
+            def succeeded(self, event):
+                self.ops.append(event["op"])
+
+        M.mgr.add_listener(Trips())
+        docs = [M.new(self.dat) for x in range(5)]
+        M.save_all(docs)
+        self.assertEqual(1, Trips.ops.count("nextval"))
+        ids = [d.fld_id for d in docs]
+        self.assertEqual(range(ids[0], ids[0] + 5), ids)
+
+    def test_FieldIndex(self):
+        class N(Doc):
+            fields = [Field(str, "astr")]
+            
+        class M(Doc):
+            fields = [Field(str, "fld1"),
+                      AutoIncField("fld_id", "testseq"),
+                      ListOfDocsField(N, "alist"),
+                      Field(N, "ndoc")]
+        
+        idx = M._fieldindex()
+        self.assertTrue(idx is M._fieldindex())
+        self.assertEqual(idx.names, frozenset(["fld1", "fld_id", "alist", "ndoc"]))
+        self.assertEqual([f.name for f in idx.autoinc], ["fld_id"])
+        self.assertEqual([f.name for f in idx.listofdocs], ["alist"])
+        self.assertEqual([f.name for f in idx.nested], ["ndoc"])
+        
+        # Fields added after the fact are picked up
+        M.fields.append(Field(str, "late"))
+        m = M.new({"fld1": "x"})
+        m.late = "set as item"
+        self.assertEqual(m["late"], "set as item")
+        self.assertTrue("late" in M._fieldindex().names)
+
+    def test_validateMany(self):
+        req = Field(str, "fld1", required=True)
+        class M(Doc):
+            fields = [req,
+                      Field(str, "fld2")]
+            
+        docs = [M.new(self.dat), M.new({"fld2": "x"}), M.new(self.dat)]
+        del docs[2]["fld1"]
+        
+        report = M.validate_many(docs)
+        self.assertEqual(report["checked"], 3)
+        self.assertEqual(report["invalid"], 2)
+        self.assertEqual(sorted(report["errors"].keys()), [1, 2])
+        self.assertEqual(report["errors"][1]["fld1"], "fld1 is required")
+        self.assertEqual(docs[2].errors()["fld1"], "fld1 is required")
+        self.assertEqual(docs[0].errors(), {})
+        
+        # Validating docs leaves the shared Field alone
+        self.assertEqual(req.error, None)
+
+    def test_Projection(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1", required=True),
+                      Field(str, "fld2", required=True),
+                      Field(str, "fld3", default="field3")]
+        
+        M.new(self.dat).save()
         
+        m = M.find({"fld1": "field-one"}, projection=["fld1"])[0]
+        self.assertEqual(m.fld1, "field-one")
+        self.assertFalse(m.has_key("fld2"))
+        self.assertFalse(m.has_key("fld3"))
+        # fld2 wasn't loaded, so it isn't "missing"
+        self.assertTrue(m.is_valid())
+        
+        m.fld1 = "changed"
+        self.assertRaises(OCMNotAllowedException, m.save)
+        
+        m.reload()
+        self.assertEqual(m.fld1, "changed")
+        self.assertEqual(m.fld2, "field-two")
+        self.assertTrue(m.save())
+        
+        o = M.retrieve({"_id": m._id}, projection=["fld2"])
+        self.assertEqual(o.fld2, "field-two")
+        self.assertFalse(o.has_key("fld1"))
+        
+        Connection('localhost', 27017).test.test.remove({"_id": m._id})
+
+    def test_LazyListOfDocs(self):
+        class N(Doc):
+            fields = [Field(str, "n-fld1"),
+                      Field(int, "n-fld2-int")]
+            
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [ListOfDocsField(N, "alist"),
+                      ListOfDocsField(N, "blist", lazy=False)]
+        
+        items = [{"n-fld1": "a", "n-fld2-int": "1"},
+                 {"n-fld1": "b", "n-fld2-int": "2"}]
+        m = M.new({"alist": items, "blist": items})
+        
+        self.assertTrue(isinstance(m["alist"], LazyDocList))
+        self.assertFalse(isinstance(m["blist"], LazyDocList))
+        self.assertTrue(isinstance(m["blist"][0], N))
+        
+        # Nothing hydrated until read
+        self.assertFalse(isinstance(list.__getitem__(m["alist"], 0), N))
+        
+        self.assertTrue(isinstance(m.alist[1], N))
+        self.assertEqual(m.alist[1]["n-fld2-int"], 2)
+        self.assertFalse(isinstance(list.__getitem__(m["alist"], 0), N))
+        self.assertTrue(m.alist[1] is m.alist[1])
+        
+        self.assertEqual([x["n-fld1"] for x in m.alist], ["a", "b"])
+        self.assertTrue(all(isinstance(x, N) for x in m.alist[:]))
+        
+        m.save()
+        o = M.retrieve({"_id": m._id})
+        self.assertEqual(o.alist[0]["n-fld2-int"], 1)
+        self.assertEqual(len(o.alist), 2)
+        Connection('localhost', 27017).test.test.remove({"_id": m._id})
+
+    def test_Update(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1"),
+                      Field(int, "hits"),
+                      ListField(str, "tags")]
+        
+        for x in range(3):
+            M.new({"fld1": "upd", "hits": 0, "tags": []}).save()
+            
+        r = M.update({"fld1": "upd"}, {"$inc": {"hits": "2"}, "$push": {"tags": 7}})
+        self.assertEqual(r["matched"], 1)
+        
+        r = M.update({"fld1": "upd"}, {"$inc": {"hits": 1}}, multi=True)
+        self.assertEqual(r["matched"], 3)
+        
+        hits = sorted(m.hits for m in M.find({"fld1": "upd"}))
+        self.assertEqual(hits, [1, 1, 3])
+        tagged = M.find({"hits": 3})[0]
+        self.assertEqual(tagged["tags"], ["7"])
+        
+        self.assertEqual({"$set": {"hits": 5}, "$unset": {"fld1": 1}},
+                         M._makeNiceChanges({"$set": {"hits": "5"}, "$unset": {"fld1": 1}}))
+
+        # Operators that don't take field values pass through untouched
+        for changes in ({"$pop": {"tags": 1}},
+                        {"$currentDate": {"fld1": True}},
+                        {"$bit": {"hits": {"and": 5}}}):
+            self.assertEqual(changes, M._makeNiceChanges(changes))
+        
+        Connection('localhost', 27017).test.test.remove({"fld1": "upd"})
+
+    def test_Remove(self):
+        deleted = []
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1"),
+                      Field(str, "fld2")]
+            
+        class H(M):
+            def before_del(self, item):
+                return item.fld2 != "keep"
+            def after_del(self, item):
+                deleted.append(item._id)
+            
+        self.assertRaises(OCMNotAllowedException, M.remove)
+        self.assertFalse(M._has_del_hooks())
+        self.assertTrue(H._has_del_hooks())
+        
+        for x in range(4):
+            M.new({"fld1": "rm", "fld2": str(x)}).save()
+        M.new({"fld1": "rm", "fld2": "keep"}).save()
+        
+        self.assertEqual(2, M.remove({"fld2": {"$in": ["0", "1"]}}))
+        self.assertEqual(3, M.count({"fld1": "rm"}))
+        
+        # _ids given as strings are coerced, like in any other criteria
+        ids = [str(m._id) for m in M.find({"fld1": "rm"})]
+        self.assertEqual(2, H.delete_ids(ids))
+        self.assertEqual(2, len(deleted))
+        kept = M.find({"fld1": "rm"})
+        self.assertEqual(["keep"], [m.fld2 for m in kept])
+        self.assertEqual("keep", M.retrieve({"_id": str(kept[0]._id)}).fld2)
+        self.assertEqual(1, M.count({"_id": {"$in": ids}}))
+
+        # None matches missing or null fields, so it isn't coerced
+        M.new({"fld1": "rm"}).save()
+        self.assertEqual(1, M.count({"fld1": "rm", "fld2": {"$ne": None}}))
+        self.assertEqual(1, M.count({"fld1": "rm", "fld2": None}))
+        self.assertEqual(2, M.count({"fld1": "rm", "fld2": {"$in": [None, "keep"]}}))
+        self.assertEqual({"_id": {"$ne": None}, "fld2": {"$nin": [None]}},
+                         M._makeNiceSpec(M, {"_id": {"$ne": None}, "fld2": {"$nin": [None]}}))
+        
+        self.assertEqual(2, M.remove({"fld1": "rm"}))
+        
+        M.new(self.dat).save()
+        M.remove(None, confirmNoCriteria=True)
+        self.assertEqual(0, M.count())
+
+    def test_Parallel(self):
+        rows = [{"_id": bson.objectid.ObjectId(), "fld1": "p%d" % i, "num": "%d" % i,
+                 "items": [{"sku": "a", "qty": i}]} for i in range(1200)]
+        
+        docs = list(POrder.mgr._hydrate(POrder, [dict(r) for r in rows], workers=2))
+        self.assertEqual(range(1200), [d.num for d in docs])
+        self.assertTrue(isinstance(docs[0], POrder))
+        self.assertEqual({}, docs[5]._changes())
+        self.assertTrue(isinstance(docs[5]["items"], LazyDocList))
+        self.assertEqual(5, docs[5]["items"][0].qty)
+        docs[5]["items"][0].qty = 6
+        self.assertEqual({"$set": {"items": docs[5]["items"]}}, docs[5]._changes())
+        
+        # Pickling isn't a change
+        o = pickle.loads(pickle.dumps(docs[7], 2))
+        self.assertEqual(docs[7], o)
+        self.assertEqual({}, o._changes())
+        
+        POrder.save_all([POrder.new(r) for r in rows[:30]])
+        found = POrder.find({"fld1": {"$in": ["p1", "p2", "p29"]}}, sort="num", workers=2)
+        self.assertEqual([1, 2, 29], [d.num for d in found])
+        
+        docs = [POrder.new(r) for r in rows[:700]]
+        del docs[3]["fld1"]
+        del docs[650]["fld1"]
+        report = POrder.validate_many(docs, workers=3)
+        self.assertEqual([3, 650], sorted(report["errors"].keys()))
+        self.assertEqual({"fld1": "fld1 is required"}, docs[650].errors())
+        
+        class M(Doc):
+            fields = [Field(str, "fld1")]
+        self.assertRaises(OCMNotAllowedException, list, 
+                          POrder.mgr._hydrate(M, [{"fld1": "x"}], workers=2))
+
+
 if __name__ == "__main__":
     unittest.main()
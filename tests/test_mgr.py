@@ -1,5 +1,7 @@
 import unittest
 import pymongo
+import threading
+import logging
 from pymongo import Connection
 
 from ocm import *
@@ -173,8 +175,642 @@ class TestMgr(unittest.TestCase):
         
         e.delete()
         self.assertEqual(1, M.count())
+
+    def test_poolReusesConnections(self):
+        m = Mgr("localhost", 27017, "test", max_pool_size=2)
+        d = self.getDocNew()
+        
+        for x in range(5):
+            m.save(d)
+        m.count("test")
+        m.get(d.__class__)
+        
+        stats = m.pool_stats()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["idle"], 1)
+        
+        m.close()
+        self.assertEqual(m.pool_stats()["idle"], 0)
+        
+        # Still usable after close - a new pool is made
+        self.assertEqual(1, m.count("test"))
+        
+    def test_poolWaitTimeout(self):
+        p = Pool("localhost", 27017, max_size=1, wait_timeout=0.1)
+        c = p.checkout()
+        self.assertRaises(OCMPoolTimeoutException, p.checkout)
+        self.assertEqual(p.stats()["waits"], 1)
+        
+        p.checkin(c)
+        self.assertEqual(p.checkout(), c)
+        p.close()
+        
+    def test_mgrContextManager(self):
+        with Mgr("localhost", 27017, "test") as m:
+            m.count("test")
+            self.assertEqual(m.pool_stats()["idle"], 1)
+        self.assertEqual(m.pool_stats()["created"], 0)
+
+    def test_saveManyOrdered(self):
+        m = Mgr("localhost", 27017, "test")
+        coll = self.getColl()
+        coll.ensure_index("fld1", unique=True)
+        try:
+            docs = [self.getDocNew() for x in range(3)]
+            docs[1].fld1 = "other"
+            docs[2].fld1 = "third"
+            coll.insert({"fld1": "other"})
+            
+            # 2nd one collides, so the 3rd isn't tried
+            res = m.save_many(docs)
+            self.assertEqual(res[0], None)
+            self.assertTrue(res[1])
+            self.assertEqual(res[2], NOT_ATTEMPTED)
+            self.assertTrue(docs[0].has_key("_id"))
+            self.assertFalse(docs[1].has_key("_id"))
+            self.assertFalse(docs[2].has_key("_id"))
+            
+            # Unordered keeps going past the collision
+            docs = [self.getDocNew() for x in range(3)]
+            docs[0].fld1 = "x"
+            docs[1].fld1 = "other"
+            docs[2].fld1 = "y"
+            res = m.save_many(docs, batch_size=1, ordered=False)
+            self.assertEqual(res[0], None)
+            self.assertTrue(res[1])
+            self.assertEqual(res[2], None)
+            self.assertEqual(4, len(self.getAllStickies()))
+        finally:
+            coll.drop_indexes()
+
+    def test_iterGet(self):
+        m = Mgr("localhost", 27017, "test")
+        for x in range(5):
+            self.getDocNew().save()
+        M = self.getDocNew().__class__
+        
+        it = M.iter_find({"fld1": "field-one"}, batch_size=2)
+        self.assertFalse(isinstance(it, list))
+        
+        first = it.next()
+        self.assertTrue(isinstance(first, M))
+        self.assertEqual(4, len(list(it)))
+        self.assertEqual(0, M.mgr.pool_stats()["checked_out"])
+        
+        it = m.iter_get(M)
+        it.next()
+        self.assertEqual(1, m.pool_stats()["checked_out"])
+        it.close()
+        self.assertEqual(0, m.pool_stats()["checked_out"])
+
+    def test_nextvalBlocks(self):
+        m1 = Mgr("localhost", 27017, "test")
+        m2 = Mgr("localhost", 27017, "test")
+        
+        a = [m1._nextval("blk_seq", block_size=10) for x in range(3)]
+        self.assertEqual(a, [1, 2, 3])
+        
+        # m2 gets its own block past m1's
+        self.assertEqual(11, m2._nextval("blk_seq", block_size=10))
+        
+        coll = self.getColl().database.sequences
+        self.assertEqual(20, coll.find_one({"seqname": "blk_seq"})["lastval"])
+        
+        # m1 runs out of its block and reserves a new one
+        a = [m1._nextval("blk_seq", block_size=10) for x in range(8)]
+        self.assertEqual(a[-1], 21)
+
+    def test_nextvalUpserts(self):
+        m = Mgr("localhost", 27017, "test")
+        coll = self.getColl().database.sequences
+        
+        self.assertEqual(1, m._nextval("ups_seq"))
+        self.assertEqual(2, m._nextval("ups_seq"))
+        self.assertEqual(1, coll.find({"seqname": "ups_seq"}).count())
+        
+        # a second Mgr shares the same sequence document
+        self.assertEqual(3, Mgr("localhost", 27017, "test")._nextval("ups_seq"))
+
+    def test_nextvalDuplicateSequences(self):
+        # Duplicate sequence docs from before the unique index existed
+        # mustn't stop _nextval
+        coll = self.getColl().database.sequences
+        if SEQUENCE_INDEX.name in coll.index_information():
+            coll.drop_index(SEQUENCE_INDEX.name)
+        coll.insert({"seqname": "dup_seq", "lastval": 5})
+        coll.insert({"seqname": "dup_seq", "lastval": 5})
+
+        logging.getLogger("ocm").disabled = True
+        try:
+            self.assertEqual(6, Mgr("localhost", 27017, "test")._nextval("dup_seq"))
+        finally:
+            logging.getLogger("ocm").disabled = False
+            coll.remove({"seqname": "dup_seq"})
+
+    def test_sessionIdentityMap(self):
+        d = self.getDocNew()
+        M = d.__class__
+        d.save()
+        
+        # No session - a fresh object each time
+        self.assertFalse(M.retrieve({"_id": d._id}) is M.retrieve({"_id": d._id}))
+        
+        with M.mgr.session() as s:
+            a = M.retrieve({"_id": d._id})
+            self.assertTrue(a is M.retrieve({"_id": d._id}))
+            self.assertTrue(a is M.find({"fld1": "field-one"})[0])
+            # An operator on _id goes to the server
+            self.assertTrue(a is M.retrieve({"_id": {"$in": [d._id]}}))
+            
+            n = M.new(self.dat)
+            n.save()
+            self.assertTrue(n is M.retrieve({"_id": n._id}))
+            
+            n.delete()
+            self.assertEqual(None, s.get(M.collection, n._id))
+            
+        self.assertEqual(None, M.mgr._session())
+
+    def test_queryCache(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            cache = QueryCache(max_size=2, ttl=60)
+            fields = [Field(str, "fld1"),
+                      Field(str, "fld2")]
+        
+        M.new(self.dat).save()
+        self.assertEqual(1, len(M.find({"fld1": "field-one"})))
+        self.assertEqual(1, M.count())
+        
+        # Changed behind the cache's back - still the cached answers
+        self.getColl().insert(dict(self.dat))
+        self.assertEqual(1, len(M.find({"fld1": "field-one"})))
+        self.assertEqual(1, M.count())
+        self.assertEqual(M.cache.stats()["hits"], 2)
+        
+        # Cached docs are copies
+        M.find({"fld1": "field-one"})[0].fld2 = "changed"
+        self.assertEqual("field-two", M.find({"fld1": "field-one"})[0].fld2)
+        
+        # A save through a Mgr drops the collection's entries
+        M.new(self.dat).save()
+        self.assertEqual(3, M.count())
+        self.assertEqual(1, M.cache.stats()["size"])
+        
+        M.find({"fld2": "a"})
+        M.find({"fld2": "b"})
+        self.assertEqual(M.cache.stats()["evictions"], 1)
+
+    def test_saveSendsChanges(self):
+        class N(Doc):
+            fields = [Field(str, "sub1")]
+            
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1"),
+                      Field(str, "fld2"),
+                      Field(N, "ndoc"),
+                      ListOfDocsField(N, "items")]
+        
+        d = M.new({"fld1": "a", "fld2": "b", "ndoc": {"sub1": "s"},
+                   "items": [{"sub1": "i1"}, {"sub1": "i2"}]})
+        self.assertEqual(None, d._changes())
+        d.save()
+        self.assertEqual({}, d._changes())
+        
+        m = M.retrieve({"_id": d._id})
+        self.assertEqual({}, m._changes())
+        
+        # Someone else changes fld2; our save of fld1 mustn't undo it
+        self.getColl().update({"_id": d._id}, {"$set": {"fld2": "theirs"}})
+        m.fld1 = "mine"
+        self.assertEqual({"$set": {"fld1": "mine"}}, m._changes())
+        m.save()
+        
+        p = self.getColl().find_one({"_id": d._id})
+        self.assertEqual(p["fld1"], "mine")
+        self.assertEqual(p["fld2"], "theirs")
+        
+        # Nested changes dirty the field they're under
+        m = M.retrieve({"_id": d._id})
+        m.ndoc["sub1"] = "changed"
+        m["items"][1]["sub1"] = "changed too"
+        del m["fld2"]
+        self.assertEqual({"$set": {"ndoc": m.ndoc, "items": m["items"]},
+                          "$unset": {"fld2": 1}}, m._changes())
+        m.save()
+        
+        p = self.getColl().find_one({"_id": d._id})
+        self.assertEqual(p["ndoc"]["sub1"], "changed")
+        self.assertEqual(p["items"][1]["sub1"], "changed too")
+        self.assertFalse(p.has_key("fld2"))
+        self.assertEqual({}, m._changes())
+
+    def test_saveAfterDelete(self):
+        gone = []
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1")]
+
+            def after_del(self, item):
+                gone.append(item)
+
+        # A deleted doc is written whole by the next save
+        m = M.new({"fld1": "del"})
+        m.save()
+        m.delete()
+        self.assertEqual(0, M.count({"fld1": "del"}))
+        self.assertTrue(m.save())
+        self.assertEqual(1, M.count({"fld1": "del"}))
+
+        m.delete()
+        m.fld1 = "del2"
+        m.save()
+        self.assertEqual(1, M.count({"fld1": "del2"}))
+
+        # Same for the docs remove() hands to the hooks
+        self.assertEqual(1, M.remove({"fld1": "del2"}))
+        self.assertEqual(None, gone[0]._changes())
+        gone[0].save()
+        self.assertEqual(1, M.count({"fld1": "del2"}))
+
+    def test_saveSendsPrebuiltChanges(self):
+        # Docs built before they're put in another doc or a LazyDocList
+        # report their changes the same as loaded ones
+        class N(Doc):
+            fields = [Field(str, "sub1")]
+
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1"),
+                      Field(N, "ndoc"),
+                      ListOfDocsField(N, "items")]
+
+        m = M.new({"fld1": "a", "ndoc": N.new({"sub1": "s"}),
+                   "items": [N.new({"sub1": "i1"})]})
+        m.save()
+
+        m.ndoc["sub1"] = "x"
+        self.assertEqual({"$set": {"ndoc": m.ndoc}}, m._changes())
+        m.save()
+
+        m["items"][0]["sub1"] = "y"
+        self.assertEqual({"$set": {"items": m["items"]}}, m._changes())
+        m.save()
+
+        m["items"].append(N.new({"sub1": "i2"}))
+        m["items"].insert(0, N.new({"sub1": "i0"}))
+        m.save()
+        m["items"][2]["sub1"] = "z"
+        m["items"][0]["sub1"] = "w"
+        self.assertEqual({"$set": {"items": m["items"]}}, m._changes())
+        m.save()
+
+        m["items"][1] = N.new({"sub1": "i1"})
+        m.save()
+        m["items"][1]["sub1"] = "v"
+        self.assertEqual({"$set": {"items": m["items"]}}, m._changes())
+        m.save()
+
+        p = self.getColl().find_one({"_id": m._id})
+        self.assertEqual("x", p["ndoc"]["sub1"])
+        self.assertEqual(["w", "v", "z"], [i["sub1"] for i in p["items"]])
+
+    def test_page(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1"),
+                      Field(int, "rank")]
+        
+        for x in range(7):
+            M.new({"fld1": "pg", "rank": x / 2}).save()
+        M.new({"fld1": "other", "rank": 0}).save()
+        
+        seen = []
+        docs, token = M.page({"fld1": "pg"}, "rank", limit=3)
+        pages = 1
+        seen.extend(docs)
+        while token:
+            docs, token = M.page({"fld1": "pg"}, "rank", limit=3, token=token)
+            seen.extend(docs)
+            pages += 1
+        
+        self.assertEqual(3, pages)
+        self.assertEqual([0, 0, 1, 1, 2, 2, 3], [d.rank for d in seen])
+        self.assertEqual(7, len(set(d._id for d in seen)))
+        
+        docs, token = M.page(None, direction=-1, limit=8)
+        self.assertEqual(None, token)
+        self.assertEqual(8, len(docs))
+        
+        self.assertRaises(OCMInvalidException, M.page, None, token="junk")
+
+        # Docs without a rank sort first, and a page ending on one
+        # mustn't lose the ranked docs after it
+        for x in range(3):
+            M.new({"fld1": "pg"}).save()
+        for direction in (1, -1):
+            seen = []
+            token = None
+            while True:
+                docs, token = M.page({"fld1": "pg"}, "rank", direction, limit=2, token=token)
+                seen.extend(docs)
+                if not token:
+                    break
+            ranks = [None, None, None, 0, 0, 1, 1, 2, 2, 3]
+            if direction < 0:
+                ranks.reverse()
+            self.assertEqual(ranks, [d.get("rank") for d in seen])
+            self.assertEqual(10, len(set(d._id for d in seen)))
+
+    def test_findOptions(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1"),
+                      Field(int, "rank")]
+        
+        M.remove({"fld1": "fo"})
+        for x in range(5):
+            M.new({"fld1": "fo", "rank": x}).save()
+        
+        docs = M.find({"fld1": "fo"}, sort=[("rank", -1)], limit=2)
+        self.assertEqual([4, 3], [d.rank for d in docs])
+        
+        docs = M.find({"fld1": "fo"}, sort="rank", skip=1, limit=2)
+        self.assertEqual([1, 2], [d.rank for d in docs])
+        
+        docs = list(M.iter_find({"fld1": "fo"}, sort="rank", skip=3))
+        self.assertEqual([3, 4], [d.rank for d in docs])
+        
+        self.assertEqual(4, M.first({"fld1": "fo"}, sort=[("rank", -1)]).rank)
+        self.assertEqual(None, M.first({"fld1": "nothing"}))
+
+    def test_asyncMgr(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1"),
+                      Field(int, "rank")]
+        
+        M.remove({"fld1": "am"})
+        futures = [M.new({"fld1": "am", "rank": x}).save_async() for x in range(10)]
+        self.assertEqual([True] * 10, [f.result() for f in futures])
+        
+        self.assertEqual(10, M.count_async({"fld1": "am"}).result())
+        docs = M.find_async({"fld1": "am"}, sort="rank", limit=3).result()
+        self.assertEqual([0, 1, 2], [d.rank for d in docs])
+        
+        with AsyncMgr(M.mgr, workers=4) as amgr:
+            batches = [f.result() for f in amgr.iter_get(M, {"fld1": "am"}, batch_size=4, sort="rank")]
+            self.assertEqual([4, 4, 2], [len(b) for b in batches])
+            self.assertEqual(range(10), [d.rank for b in batches for d in b])
+            
+            vals = [amgr._nextval("test_asyncmgr").result() for x in range(3)]
+            self.assertEqual(vals[0] + 2, vals[2])
+        
+        M.mgr.close()
+
+    def test_threads(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test", max_pool_size=8)
+            collection = "test"
+            fields = [AutoIncField("num", "test_threads"),
+                      Field(str, "fld1", required=True),
+                      Field(int, "rank")]
+        
+        M.remove({"fld1": "th"})
+        got = []
+        failures = []
+        lock = threading.Lock()
+        def work(t):
+            try:
+                mine = []
+                for x in range(20):
+                    o = M.new({"fld1": "th", "rank": t})
+                    self.assertTrue(o.save())
+                    mine.append(o.num)
+                    mine.append(M.mgr._nextval("test_threads"))
+                    self.assertTrue(M.find({"fld1": "th", "rank": t}))
+                    self.assertEqual({"fld1": "fld1 is required"}, M.new({}).errors())
+                lock.acquire()
+                got.extend(mine)
+                lock.release()
+            except Exception, e:
+                failures.append(e)
+        
+        threads = [threading.Thread(target=work, args=(t,)) for t in range(32)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        self.assertEqual([], failures)
+        self.assertEqual(range(1, 32 * 40 + 1), sorted(got))
+        self.assertEqual(32 * 20, M.count({"fld1": "th"}))
+        M.mgr.close()
+
+    def test_ensureIndexes(self):
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test_indexes"
+            fields = [Field(str, "email"),
+                      Field(str, "customer"),
+                      Field(datetime, "created")]
+            indexes = [Index("email", unique=True, sparse=True),
+                       Index([("customer", 1), ("created", -1)]),
+                       Index("created", ttl=3600)]
+        
+        with M.mgr._db() as mdb:
+            mdb.test_indexes.drop()
+            mdb.sequences.drop()
+        
+        self.assertEqual({"sequences": {"missing": ["seqname_1"], "changed": [], "extra": []},
+                          "test_indexes": {"missing": ["email_1", "customer_1_created_-1",
+                                                       "created_1"],
+                                           "changed": [], "extra": []}},
+                         M.mgr.index_drift(M))
+        
+        made = M.mgr.ensure_indexes(M)
+        self.assertEqual(4, len(made))
+        self.assertTrue(("sequences", "seqname_1") in made)
+        self.assertEqual([], M.mgr.ensure_indexes(M))
+        self.assertEqual({}, M.mgr.index_drift(M))
+        
+        M.new({"email": "a@b"}).save()
+        self.assertRaises(pymongo.errors.DuplicateKeyError, M.new({"email": "a@b"}).save)
+        
+        with M.mgr._db() as mdb:
+            mdb.test_indexes.drop_index("created_1")
+            mdb.test_indexes.create_index("created", name="created_1")
+            mdb.test_indexes.create_index("customer")
+        self.assertEqual({"test_indexes": {"missing": [], "changed": ["created_1"],
+                                           "extra": ["customer_1"]}},
+                         M.mgr.index_drift(M))
+        
+        with M.mgr._db() as mdb:
+            mdb.test_indexes.drop()
+
+    def test_listeners(self):
+        class Recorder(Listener):
+            def __init__(self):
+                self.events = []
+            def started(self, event):
+                self.events.append(("started", event["op"]))
+            def succeeded(self, event):
+                self.events.append(("succeeded", event))
+            def failed(self, event):
+                self.events.append(("failed", event))
+        
+        class Broken(Listener):
+            def started(self, event):
+                raise ValueError("listener bug")
+        
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test_listeners"
+            fields = [AutoIncField("num", "test_listeners"),
+                      Field(str, "fld1"),
+                      Field(int, "rank")]
+        
+        rec = Recorder()
+        slow = SlowQueryLogger(threshold_ms=0, logger=logging.getLogger("test_listeners"))
+        logging.getLogger("test_listeners").disabled = True
+        logging.getLogger("ocm").disabled = True
+        M.mgr.add_listener(rec)
+        M.mgr.add_listener(Broken())
+        M.mgr.add_listener(slow)
+        
+        o = M.new({"fld1": "secret", "rank": 3})
+        o.save()
+        found = M.find({"fld1": "secret", "rank": {"$gt": 1}})
+        M.retrieve({"_id": o._id})
+        M.count({"fld1": "secret"})
+        o.delete()
         
+        done = [e for what, e in rec.events if what == "succeeded"]
+        self.assertEqual(["nextval", "save", "find", "retrieve", "count", "delete"],
+                         [e["op"] for e in done])
+        self.assertEqual(12, len(rec.events))
         
+        find = done[2]
+        self.assertEqual("test_listeners", find["collection"])
+        self.assertEqual("{fld1: ?, rank: {$gt: ?}}", find["shape"])
+        self.assertEqual(1, find["docs"])
+        self.assertEqual(len(BSON.encode(found[0])), find["bytes"])
+        self.assertTrue(find["duration_ms"] >= 0)
         
+        # Values never make it into the slow log
+        self.assertEqual(6, len(slow.entries))
+        self.assertFalse("secret" in repr(list(slow.entries)))
+        self.assertEqual(6, sum(s["count"] for s in slow.summary()))
+        
+        M.indexes = [Index("fld1", unique=True)]
+        M.mgr.ensure_indexes(M)
+        del rec.events[:]
+        M.save_all([M.new({"fld1": "x"}), M.new({"fld1": "x"})])
+        failed = [e for what, e in rec.events if what == "failed"]
+        self.assertEqual(["insert"], [e["op"] for e in failed])
+        self.assertTrue(isinstance(failed[0]["error"], OperationFailure))
+        
+        M.mgr.remove_listener(rec)
+        M.count()
+        self.assertFalse([e for what, e in rec.events if what == "succeeded" and 
+                                                        e["op"] == "count"])
+        M.mgr.remove_listener(slow)
+        logging.getLogger("ocm").disabled = False
+        with M.mgr._db() as mdb:
+            mdb.test_listeners.drop()
+
+    def test_profile(self):
+        class Addr(Doc):
+            fields = [Field(str, "city")]
+        
+        class M(Doc):
+            mgr = Mgr("localhost", 27017, "test")
+            collection = "test"
+            fields = [Field(str, "fld1", required=True),
+                      Field(Addr, "addr")]
+            
+            def before_save(self, item):
+                return True
+        
+        with profile() as p:
+            M.new({"fld1": "pr", "addr": {"city": "x"}}).save()
+            M.new({"fld1": "pr", "addr": {"city": "y"}}).save()
+            self.assertEqual(2, len(M.find({"fld1": "pr"})))
+        
+        r = p.report()
+        self.assertEqual(set(Profile.PHASES), set(r))
+        self.assertEqual(4, r["hydrate"]["M"]["calls"])
+        self.assertEqual(4, r["hydrate"]["Addr"]["calls"])
+        self.assertEqual(3, r["network"]["M"]["calls"])
+        # before_save, after_save, and validate() from new() and save()
+        self.assertEqual(2 + 2 + 6, r["hooks"]["M"]["calls"])
+        self.assertTrue(r["validate"]["M"]["total_ms"] >= 0)
+        self.assertTrue("hydrate   Addr" in p.table())
+        
+        M.find({"fld1": "pr"})
+        self.assertEqual(r, p.report())
+        
+        with profile(M.mgr) as p:
+            self.assertEqual(2, M.count({"fld1": "pr"}))
+        self.assertEqual({"network": {"test": {"calls": 1, 
+                                               "total_ms": p.report()["network"]["test"]["total_ms"]}}}, 
+                         p.report())
+        self.assertEqual(None, M.mgr._profile)
+        
+        p = M.mgr.start_profile()
+        M.find({"fld1": "pr"})
+        self.assertEqual(p, M.mgr.stop_profile())
+        self.assertEqual(1, p.report()["network"]["M"]["calls"])
+
+        # Blocks in two threads overlapping: A opens, B opens, A closes
+        a = profile()
+        pa = a.__enter__()
+        b = profile()
+        pb = b.__enter__()
+        a.__exit__(None, None, None)
+        M.count({"fld1": "pr"})
+        b.__exit__(None, None, None)
+        self.assertEqual(1, pb.report()["network"]["test"]["calls"])
+
+        p = M.mgr.start_profile()
+        M.count({"fld1": "pr"})
+        M.mgr.stop_profile()
+        self.assertEqual(1, p.report()["network"]["test"]["calls"])
+        self.assertEqual({}, pa.report())
+        self.assertEqual(1, pb.report()["network"]["test"]["calls"])
+
+        # A Mgr's own profile still records inside a profile() block
+        mine = M.mgr.start_profile()
+        with profile() as p:
+            for x in range(5):
+                M.new({"fld1": "pr"})
+            M.count({"fld1": "pr"})
+        M.mgr.stop_profile()
+        for r in (p.report(), mine.report()):
+            self.assertEqual(5, r["hydrate"]["M"]["calls"])
+            self.assertEqual(1, r["network"]["test"]["calls"])
+
+    def test_connectFactory(self):
+        made = []
+        def connect(host, port):
+            made.append((host, port))
+            return Connection(host, port)
+        
+        mgr = Mgr("localhost", 27017, "test", connect=connect)
+        mgr.count("test")
+        mgr.count("test")
+        self.assertEqual([("localhost", 27017)], made)
+        mgr.close()
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file